@@ -3,7 +3,6 @@
 #include <ESP8266WebServer.h>
 #include <WiFiManager.h>
 #include <ESP8266HTTPClient.h>
-#include <WiFiClientSecure.h>
 #include <SoftwareSerial.h>
 #include <EEPROM.h>
 #include <ArduinoJson.h>
@@ -14,20 +13,29 @@
 // 與 UNO 的序列通訊
 SoftwareSerial espSerial(3, 2); // D3=RX, D2=TX (依接線調整)
 
-// ---------------------- Google Sheets 和 Flask 設定 ----------------------
-const String scriptURL = "https://script.google.com/macros/s/'yourAppScriptsKey'/exec";
+// ---------------------- Flask 設定 ----------------------
+// 感測數據批次上傳到 Flask 的 /api/ingest，由伺服器鏡像到 Google Sheets
 const String FLASK_SERVER_URL = "http://192.168.0.146:5000";
 
-// 遠端檢查間隔（單位：毫秒）
-const unsigned long RESET_CHECK_INTERVAL = 60 * 1000;
-const unsigned long COMMAND_CHECK_INTERVAL = 5 * 1000;
-unsigned long lastResetCheck = 0;
-unsigned long lastCommandCheck = 0;
+// 感測數據批次上傳：累積 INGEST_BATCH_SIZE 筆或超過 INGEST_INTERVAL 毫秒就上傳一次
+const int INGEST_BATCH_SIZE = 12;
+const unsigned long INGEST_INTERVAL = 60 * 1000;
+String pendingReadings[INGEST_BATCH_SIZE];
+unsigned long pendingReadingTimes[INGEST_BATCH_SIZE];
+int pendingCount = 0;
+unsigned long lastIngest = 0;
+
+// 長輪詢等待時間（單位：秒）：伺服器在有指令或遠端重設時立即回應，否則等到逾時。
+// 等待期間無法讀取 UNO 的序列資料（每 5 秒一筆，SoftwareSerial 緩衝區僅 64 bytes），因此不宜超過 10 秒
+const int LONG_POLL_TIMEOUT = 10;
+// 長輪詢失敗後的重試間隔（單位：毫秒）
+const unsigned long COMMAND_RETRY_INTERVAL = 5 * 1000;
+unsigned long nextCommandCheck = 0;
 
 // 函式宣告
 void registerDeviceAutomatically();
-void checkRemoteReset();
-void checkFlaskCommand();
+bool waitFlaskCommand();
+bool flushReadings();
 String getMacAddressNoColon();
 
 void setup() {
@@ -53,48 +61,38 @@ void setup() {
 }
 
 void loop() {
-  String macAddress = getMacAddressNoColon();
-
-  // ---- 接收 UNO 感測資料並上傳 Google Sheets ----
-  if (espSerial.available()) {
+  // ---- 接收 UNO 感測資料並暫存，批次上傳到 Flask ----
+  while (espSerial.available()) {
     String sensorData = espSerial.readStringUntil('\n');
     sensorData.trim();
+    if (sensorData.length() == 0) continue;
     Serial.println("從 UNO 接收到數據: " + sensorData);
 
-    if (WiFi.status() == WL_CONNECTED) {
-      WiFiClientSecure client;
-      client.setInsecure();
-
-      HTTPClient http;
-      http.begin(client, scriptURL);
-      http.addHeader("Content-Type", "application/x-www-form-urlencoded");
-      http.setTimeout(10000);
-
-      String postData = "data=" + sensorData + "&plantName=" + macAddress;
-      int httpCode = http.POST(postData);
-
-      if (httpCode > 0) {
-        Serial.println("✅ 成功發送數據到 Google Sheets");
-      } else {
-        Serial.println("❌ 數據發送失敗: " + http.errorToString(httpCode));
+    // 暫存區已滿（伺服器長時間無法連線）時捨棄最舊的一筆
+    if (pendingCount == INGEST_BATCH_SIZE) {
+      for (int i = 1; i < INGEST_BATCH_SIZE; i++) {
+        pendingReadings[i - 1] = pendingReadings[i];
+        pendingReadingTimes[i - 1] = pendingReadingTimes[i];
       }
-      http.end();
-    } else {
-      Serial.println("⚠️ Wi-Fi 未連線");
+      pendingCount--;
     }
+    pendingReadings[pendingCount] = sensorData;
+    pendingReadingTimes[pendingCount] = millis();
+    pendingCount++;
   }
 
-// ---- 定期檢查 Flask 重設指令 ----
-if (millis() - lastResetCheck >= RESET_CHECK_INTERVAL) {
-  checkRemoteReset();
-  lastResetCheck = millis();
-}
+  if (pendingCount > 0 && (pendingCount >= INGEST_BATCH_SIZE || millis() - lastIngest >= INGEST_INTERVAL)) {
+    flushReadings();
+    lastIngest = millis();
+  }
 
-// ---- 定期檢查 Flask 控制指令 ----
-if (millis() - lastCommandCheck >= COMMAND_CHECK_INTERVAL) {
-  checkFlaskCommand();
-  Serial.println(1);
-  lastCommandCheck = millis();
+// ---- 長輪詢等待 Flask 控制指令與遠端重設 ----
+if ((long)(millis() - nextCommandCheck) >= 0) {
+  if (waitFlaskCommand()) {
+    nextCommandCheck = millis();
+  } else {
+    nextCommandCheck = millis() + COMMAND_RETRY_INTERVAL;
+  }
 }
 
   // ---- 長按按鈕清除 WiFi ----
@@ -153,20 +151,54 @@ void registerDeviceAutomatically() {
   }
 }
 
-void checkRemoteReset() {
+bool flushReadings() {
+  if (WiFi.status() != WL_CONNECTED) {
+    Serial.println("⚠️ Wi-Fi 未連線");
+    return false;
+  }
+
+  // 每行「mac,-秒數,溫度,濕度,土壤濕度,光照度」，-秒數 表示該筆數據是幾秒前量測的
+  String macAddress = getMacAddressNoColon();
+  String body = "";
+  unsigned long now = millis();
+  for (int i = 0; i < pendingCount; i++) {
+    unsigned long age = (now - pendingReadingTimes[i]) / 1000;
+    body += macAddress + ",-" + String(age) + "," + pendingReadings[i] + "\n";
+  }
+
+  WiFiClient client;
+  HTTPClient http;
+  http.begin(client, FLASK_SERVER_URL + "/api/ingest");
+  http.addHeader("Content-Type", "text/csv");
+  http.setTimeout(10000);
+  int httpCode = http.POST(body);
+  http.end();
+
+  if (httpCode == HTTP_CODE_OK) {
+    Serial.printf("✅ 已上傳 %d 筆數據\n", pendingCount);
+    pendingCount = 0;
+    return true;
+  }
+  Serial.println("❌ 數據上傳失敗: " + String(httpCode));
+  return false;
+}
+
+bool waitFlaskCommand() {
+  bool ok = false;
   if (WiFi.status() == WL_CONNECTED) {
-    Serial.println(0);
     WiFiClient client;
     HTTPClient http;
 
     String macAddress = getMacAddressNoColon();
-    String url = FLASK_SERVER_URL + "/api/check_reset/" + macAddress;
+    String url = FLASK_SERVER_URL + "/api/wait_command/" + macAddress + "?timeout=" + String(LONG_POLL_TIMEOUT);
     http.begin(client, url);
+    http.setTimeout((LONG_POLL_TIMEOUT + 5) * 1000);
 
     int httpCode = http.GET();
     if (httpCode == HTTP_CODE_OK) {
+      ok = true;
       String payload = http.getString();
-      StaticJsonDocument<200> doc;
+      StaticJsonDocument<1024> doc;
       if (deserializeJson(doc, payload) == DeserializationError::Ok) {
         if (doc["reset_pending"]) {
           Serial.println("🛑 收到遠端重設，清除 Wi-Fi 設定並重啟...");
@@ -175,42 +207,26 @@ void checkRemoteReset() {
           delay(2000);
           ESP.restart();
         }
-      }
-    } else {
-      Serial.println("⚠️ 檢查重設失敗: " + String(httpCode));
-    }
-    http.end();
-  }
-}
-
-void checkFlaskCommand() {
-  if (WiFi.status() == WL_CONNECTED) {
-    WiFiClient client;
-    HTTPClient http;
-
-    String macAddress = getMacAddressNoColon();
-    String url = FLASK_SERVER_URL + "/api/get_command/" + macAddress;
-    http.begin(client, url);
-
-    int httpCode = http.GET();
-    if (httpCode == HTTP_CODE_OK) {
-      String payload = http.getString();
-      StaticJsonDocument<256> doc;
-      if (deserializeJson(doc, payload) == DeserializationError::Ok) {
         if (doc["has_command"]) {
-          int caseValue = doc["command"]["case"];
-          int thresholdValue = doc["command"]["value"];
-          String command = String(caseValue) + "," + String(thresholdValue);
-          espSerial.println(command);  // 發送給 UNO
-          Serial.println("➡️ 傳送給 UNO: " + command);
+          // 一次收到所有待執行指令，依序發送給 UNO
+          JsonArray commands = doc["commands"].as<JsonArray>();
+          for (JsonObject item : commands) {
+            int caseValue = item["case"];
+            int thresholdValue = item["value"];
+            String command = String(caseValue) + "," + String(thresholdValue);
+            espSerial.println(command);  // 發送給 UNO
+            Serial.println("➡️ 傳送給 UNO: " + command);
+            delay(50);
+          }
           
-          // ⭐ 新增: 向伺服器回報指令已處理
+          // ⭐ 新增: 向伺服器回報已處理到哪個指令 (seq)
+          long lastSeq = doc["last_seq"];
           HTTPClient postHttp;
           WiFiClient postClient;
           String postUrl = FLASK_SERVER_URL + "/api/command_executed/" + getMacAddressNoColon();
           postHttp.begin(postClient, postUrl);
           postHttp.addHeader("Content-Type", "application/json");
-          int postHttpCode = postHttp.POST("{}");
+          int postHttpCode = postHttp.POST("{\"seq\": " + String(lastSeq) + "}");
           Serial.printf("回報指令已處理，伺服器回應代碼: %d\n", postHttpCode);
           postHttp.end();
         }
@@ -220,4 +236,5 @@ void checkFlaskCommand() {
     }
     http.end();
   }
+  return ok;
 }
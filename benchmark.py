@@ -0,0 +1,239 @@
+"""
+離線效能測試：以 fake_gspread 取代 Google Sheets，產生合成的感測數據歷史，
+量測各 API 與 update.py 同步的延遲百分位數（p50/p95/p99）、吞吐量與記憶體峰值。
+
+    python benchmark.py                                   # 每株 1k / 100k 筆，3 株植物
+    python benchmark.py --rows 1000 1000000 10000000 --plants 1 --sync-rows 100000
+    python benchmark.py --latency 0.2 --quota-per-minute 60 --json results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from flask import Flask
+from sqlalchemy import text
+
+from flask_app import PlantModel, PlantController, TAIPEI_TZ, SHEET_TIME_FORMAT, SHEET_HEADERS, SENSOR_COLUMNS
+from fake_gspread import FakeClient, format_cell
+
+SHEET_ID = "benchmark-sheet"
+
+
+def synthetic_readings(rows, end_ts, interval=60, seed=0):
+    """
+    產生每 interval 秒一筆、以 end_ts 結束的感測數據，溫度與光照度帶有日夜週期，土壤濕度隨澆水鋸齒變化。
+    """
+    rng = np.random.default_rng(seed)
+    ts = end_ts - interval * np.arange(rows, dtype='int64')[::-1]
+    day = 2 * np.pi * ((ts + 8 * 3600) % 86400) / 86400
+    return pd.DataFrame({
+        "ts": ts,
+        "temperature": np.round(25 + 5 * np.sin(day - np.pi / 2) + rng.normal(0, 0.5, rows), 1),
+        "humidity": np.round(60 + 10 * np.cos(day) + rng.normal(0, 2, rows), 1),
+        "soil_moisture": np.round(80 - (ts // interval) % 2880 / 2880 * 50 + rng.normal(0, 1, rows), 1),
+        "light": np.round(np.clip(800 * np.sin(day - np.pi / 2), 0, None) + rng.uniform(0, 20, rows), 0),
+    })
+
+
+def readings_to_sheet_rows(readings):
+    """
+    轉為工作表格式的資料列（台北時間字串與數值），與 SheetsMirror 附加的內容相同。
+    """
+    times = pd.to_datetime(readings["ts"], unit='s', utc=True).dt.tz_convert(TAIPEI_TZ).dt.strftime(SHEET_TIME_FORMAT)
+    frame = pd.concat([times.rename("時間"), readings[list(SENSOR_COLUMNS.values())]], axis=1)
+    return frame.values.tolist()
+
+
+def measure(name, fn, repeat, warmup=1, setup=None):
+    """
+    執行 fn 共 repeat 次並記錄延遲；另外以 tracemalloc 多執行一次取得記憶體峰值（追蹤會拖慢執行，不計入延遲）。
+    setup 在每次執行前呼叫，不計入延遲。
+    """
+    setup = setup or (lambda: None)
+    for _ in range(warmup):
+        setup()
+        fn()
+    durations = []
+    for _ in range(repeat):
+        setup()
+        t0 = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - t0)
+    elapsed = sum(durations)
+
+    setup()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    p50, p95, p99 = np.percentile(durations, [50, 95, 99]) * 1000
+    return {
+        "name": name,
+        "n": repeat,
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "throughput": round(repeat / elapsed, 2) if elapsed > 0 else float('inf'),
+        "peak_mib": round(peak / 2 ** 20, 2),
+    }
+
+
+def get_ok(test_client, url):
+    def request():
+        response = test_client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} 回應 {response.status_code}")
+        return response
+    return request
+
+
+def run_size(rows, args):
+    """
+    建立獨立的暫存資料庫與假 Google Sheets，準備每株 rows 筆歷史數據後執行所有量測。
+    """
+    workdir = tempfile.mkdtemp(prefix="plant-benchmark-")
+    client = FakeClient(latency=args.latency, jitter=args.jitter, quota_error_rate=args.quota_error_rate,
+                        quota_per_minute=args.quota_per_minute, seed=args.seed)
+    app = Flask(__name__, root_path=workdir, template_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+    model = PlantModel(app, db_url=f"sqlite:///{os.path.join(workdir, 'bench.db')}", fixed_sheet_id=SHEET_ID,
+                       cache_ttl=args.cache_ttl, client=client)
+    PlantController(app, model)
+    test_client = app.test_client()
+    results = []
+
+    try:
+        end_ts = int(time.time()) - 3600
+        macs = [f"BE:NC:00:00:00:{i:02X}" for i in range(args.plants)]
+        for i, mac in enumerate(macs):
+            model.add_plant(f"benchmark-{i}", None, mac)
+            history = synthetic_readings(rows, end_ts, interval=args.interval, seed=args.seed + i)
+            if rows <= args.sync_rows:
+                client.seed_worksheet(SHEET_ID, mac, [SHEET_HEADERS, *readings_to_sheet_rows(history)])
+            else:
+                # 歷史太大時不經過工作表，直接寫入本地資料庫
+                client.seed_worksheet(SHEET_ID, mac, [SHEET_HEADERS])
+                for start in range(0, rows, 500000):
+                    model.store_readings(mac, history.iloc[start:start + 500000])
+            del history
+
+        # update.py：第一次完整同步；每次執行前清空本地數據與同步水位
+        def reset_local():
+            with model.engine.begin() as conn:
+                for table in ("sensor_readings", "sync_state", "latest_readings", "rollup_hourly", "rollup_daily"):
+                    conn.execute(text(f"DELETE FROM {table}"))
+            with model.latest_lock:
+                model.latest_readings = model.load_latest_readings()
+            model.data_cache.invalidate(lambda key: True)
+
+        if rows <= args.sync_rows:
+            results.append(measure("sync (full)", model.sync_worksheets, repeat=args.sync_repeat, warmup=0, setup=reset_local))
+        else:
+            model.sync_worksheets()
+
+        # update.py：每次只有少量新列的增量同步
+        appended = [0]
+
+        def incremental_sync():
+            appended[0] += 1
+            new_ts = end_ts + appended[0] * args.sync_batch * args.interval
+            for i, mac in enumerate(macs):
+                batch = synthetic_readings(args.sync_batch, new_ts, interval=args.interval, seed=args.seed + i)
+                client.spreadsheets[SHEET_ID].worksheets_by_title[mac].rows.extend(
+                    [[format_cell(v) for v in row] for row in readings_to_sheet_rows(batch)])
+            model.sync_worksheets()
+        results.append(measure(f"sync (+{args.sync_batch}/plant)", incremental_sync, repeat=args.repeat))
+
+        # 首頁與首頁輪詢
+        results.append(measure("GET /", get_ok(test_client, "/"), repeat=args.repeat))
+        results.append(measure("GET /api/latest", get_ok(test_client, "/api/latest"), repeat=args.repeat))
+        results.append(measure("GET /api/latest/<id>", get_ok(test_client, "/api/latest/1"), repeat=args.repeat))
+
+        # 歷史頁：原始數據與伺服器端聚合
+        end = datetime.fromtimestamp(end_ts, timezone.utc)
+        for label, days, bucket in [("day", 1, None), ("week", 7, None), ("month", 30, None), ("year", 365, None),
+                                    ("day", 1, "hour"), ("week", 7, "weekday"), ("month", 30, "day"), ("year", 365, "month")]:
+            start = end - pd.Timedelta(days=days)
+            url = f"/api/data/1?start={start.strftime('%Y-%m-%dT%H:%M:%SZ')}&end={end.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+            name = f"GET /api/data ({label}, raw)"
+            if bucket:
+                url += f"&bucket={bucket}&type=環境溫度"
+                name = f"GET /api/data ({label}, {bucket})"
+            results.append(measure(name, get_ok(test_client, url), repeat=args.repeat))
+
+        # 裝置批次上傳
+        ingest_round = [0]
+
+        def ingest():
+            ingest_round[0] += 1
+            base = end_ts + 86400 + ingest_round[0] * args.ingest_batch
+            body = "\n".join(f"{mac},{base + j},25.0,60.0,40.0,300"
+                             for mac in macs for j in range(args.ingest_batch))
+            response = test_client.post("/api/ingest", data=body, content_type="text/csv")
+            if response.status_code != 200:
+                raise RuntimeError(f"/api/ingest 回應 {response.status_code}")
+        results.append(measure(f"POST /api/ingest ({args.ingest_batch}x{args.plants})", ingest, repeat=args.repeat))
+
+        for result in results:
+            result["rows_per_plant"] = rows
+            result["plants"] = args.plants
+        results.append({"name": "google api calls", "rows_per_plant": rows, "plants": args.plants,
+                        "calls": dict(client.calls), "quota_errors": client.quota_errors})
+        return results
+    finally:
+        model.engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_results(results):
+    print(f"{'rows/plant':>10}  {'name':<36}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'peak MiB':>10}")
+    for r in results:
+        if "calls" in r:
+            calls = ", ".join(f"{k}={v}" for k, v in sorted(r["calls"].items()))
+            print(f"{r['rows_per_plant']:>10}  Google API 呼叫: {calls}; 429: {r['quota_errors']}")
+            continue
+        print(f"{r['rows_per_plant']:>10}  {r['name']:<36}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}"
+              f"{r['throughput']:>10}{r['peak_mib']:>10}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="以假的 Google Sheets 與合成數據量測伺服器效能")
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 100000], help="每株植物的歷史數據筆數（可指定多個）")
+    parser.add_argument('--plants', type=int, default=3, help="植物數量")
+    parser.add_argument('--interval', type=int, default=60, help="合成數據的取樣間隔（秒）")
+    parser.add_argument('--repeat', type=int, default=20, help="每項量測的執行次數")
+    parser.add_argument('--sync-rows', type=int, default=1000000, help="歷史不超過此筆數時經由工作表完整同步，否則直接寫入資料庫")
+    parser.add_argument('--sync-repeat', type=int, default=3, help="完整同步的執行次數")
+    parser.add_argument('--sync-batch', type=int, default=12, help="增量同步時每株植物新增的列數")
+    parser.add_argument('--ingest-batch', type=int, default=12, help="每次 /api/ingest 每株植物的筆數")
+    parser.add_argument('--cache-ttl', type=float, default=0, help="查詢快取秒數；0 表示量測未快取的查詢")
+    parser.add_argument('--latency', type=float, default=0.0, help="假 Google API 每次呼叫的延遲（秒）")
+    parser.add_argument('--jitter', type=float, default=0.0, help="延遲的隨機增量上限（秒）")
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help="假 Google API 隨機回傳 429 的機率")
+    parser.add_argument('--quota-per-minute', type=int, default=None, help="假 Google API 每分鐘的呼叫上限")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="將結果寫入 JSON 檔")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    all_results = []
+    for rows in args.rows:
+        print(f"準備每株 {rows} 筆、共 {args.plants} 株植物的數據...", file=sys.stderr)
+        results = run_size(rows, args)
+        print_results(results)
+        all_results.extend(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(all_results, f, ensure_ascii=False, indent=2)
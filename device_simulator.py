@@ -0,0 +1,339 @@
+"""
+ESP8266 裝置群的負載產生器：以 asyncio 模擬 N 台虛擬裝置，依照 8266_V2.ino 的請求模式呼叫伺服器，
+並從管理端定期送出 /api/set_threshold，量測指令送達裝置（delivery）與回報完成（round trip）的延遲。
+
+韌體模式：
+- legacy：原始韌體，開機註冊後每 5 秒 GET /api/get_command、每 60 秒 GET /api/check_reset，
+  收到指令後 POST /api/command_executed（感測數據直接送到 Apps Script，不經過伺服器）
+- current：目前的韌體，開機註冊後以 /api/wait_command 長輪詢（逾時 10 秒，失敗時 5 秒後重試），
+  感測數據累積 12 筆或 60 秒後以 CSV 批次 POST /api/ingest
+
+    python device_simulator.py --url http://127.0.0.1:5000 --devices 50 100 200 --duration 60
+    python device_simulator.py --serve threaded --firmware legacy --devices 100 500 1000
+    python device_simulator.py --serve gevent --boot-spread 0    # 所有裝置同時開機（註冊風暴）
+
+--serve 會在子程序中以 fake_gspread 與暫存資料庫啟動伺服器，不會在真實的試算表建立工作表；
+對真實伺服器測試時，模擬裝置會以 SIM 開頭的 MAC 位址註冊成植物。
+裝置數量較多時請先提高檔案描述元上限（ulimit -n）。
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import numpy as np
+
+# 與 8266_V2.ino 相同的時間設定（秒）
+LEGACY_COMMAND_INTERVAL = 5
+LEGACY_RESET_INTERVAL = 60
+LONG_POLL_TIMEOUT = 10
+COMMAND_RETRY_INTERVAL = 5
+INGEST_BATCH_SIZE = 12
+INGEST_INTERVAL = 60
+
+
+class HttpError(Exception):
+    pass
+
+
+class Stats:
+    """
+    記錄每個端點的延遲與錯誤，以及指令送達/完成的延遲。
+    """
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.issued = {}          # (mac, value) -> 送出時間
+        self.delivery = []
+        self.round_trip = []
+
+    def record(self, endpoint, latency, ok):
+        self.latencies[endpoint].append(latency)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def delivered(self, mac, value, received_at, acked_at):
+        sent_at = self.issued.pop((mac, value), None)
+        if sent_at is not None:
+            self.delivery.append(received_at - sent_at)
+            self.round_trip.append(acked_at - sent_at)
+
+
+def percentiles(values):
+    if not values:
+        return [float('nan')] * 3
+    return [float(v) * 1000 for v in np.percentile(values, [50, 95, 99])]
+
+
+class Client:
+    """
+    最小的 HTTP/1.1 用戶端；與 ESP8266HTTPClient 相同，每個請求使用一條新連線。
+    """
+    def __init__(self, url, stats, timeout=10):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.stats = stats
+        self.timeout = timeout
+
+    async def request(self, method, path, body=None, content_type='application/json', timeout=None, label=None):
+        timeout = timeout or self.timeout
+        label = label or f"{method} {path}"
+        started = time.monotonic()
+        try:
+            status, payload = await asyncio.wait_for(self.send(method, path, body, content_type), timeout)
+        except (OSError, asyncio.TimeoutError, HttpError, ValueError) as e:
+            self.stats.record(label, time.monotonic() - started, False)
+            return None, str(e)
+        self.stats.record(label, time.monotonic() - started, 200 <= status < 300)
+        return status, payload
+
+    async def send(self, method, path, body, content_type):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            data = body.encode() if body is not None else b''
+            head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nUser-Agent: ESP8266HTTPClient\r\nConnection: close\r\n"
+            if method == 'POST':
+                head += f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n"
+            writer.write(head.encode() + b"\r\n" + data)
+            await writer.drain()
+            raw = await reader.read()
+        finally:
+            writer.close()
+
+        header, _, payload = raw.partition(b"\r\n\r\n")
+        lines = header.decode('latin-1').split("\r\n")
+        if not lines[0].startswith("HTTP/"):
+            raise HttpError(f"無效的回應: {lines[0]!r}")
+        status = int(lines[0].split()[1])
+        if any(line.lower() == "transfer-encoding: chunked" for line in lines[1:]):
+            payload = self.dechunk(payload)
+        return status, payload.decode('utf-8', errors='replace')
+
+    def dechunk(self, payload):
+        body = b''
+        while payload:
+            size_line, _, payload = payload.partition(b"\r\n")
+            size = int(size_line.split(b';')[0], 16)
+            if size == 0:
+                break
+            body, payload = body + payload[:size], payload[size + 2:]
+        return body
+
+
+class VirtualDevice:
+    def __init__(self, mac, client, stats, args):
+        self.mac = mac
+        self.client = client
+        self.stats = stats
+        self.args = args
+
+    def jitter(self):
+        return random.uniform(0, self.args.jitter)
+
+    async def run(self, stop_at):
+        # 開機時間分散在 boot_spread 秒內；0 表示所有裝置同時開機註冊
+        await asyncio.sleep(random.uniform(0, self.args.boot_spread))
+        await self.client.request('POST', '/api/register_device_auto', json.dumps({"mac_address": self.mac}),
+                                  label='POST /api/register_device_auto')
+        if self.args.firmware == 'legacy':
+            await self.run_legacy(stop_at)
+        else:
+            await self.run_current(stop_at)
+
+    async def run_legacy(self, stop_at):
+        loop = asyncio.get_running_loop()
+        next_command = loop.time() + random.uniform(0, LEGACY_COMMAND_INTERVAL)
+        next_reset = loop.time() + random.uniform(0, LEGACY_RESET_INTERVAL)
+        while loop.time() < stop_at:
+            await asyncio.sleep(max(0, min(next_command, next_reset) - loop.time()))
+            if loop.time() >= next_reset:
+                await self.client.request('GET', f'/api/check_reset/{self.mac}', label='GET /api/check_reset')
+                next_reset = loop.time() + LEGACY_RESET_INTERVAL + self.jitter()
+            if loop.time() >= next_command:
+                status, payload = await self.client.request('GET', f'/api/get_command/{self.mac}', label='GET /api/get_command')
+                if status == 200:
+                    doc = json.loads(payload)
+                    if doc.get("has_command"):
+                        received_at = time.monotonic()
+                        await self.client.request('POST', f'/api/command_executed/{self.mac}', "{}",
+                                                  label='POST /api/command_executed')
+                        self.stats.delivered(self.mac, doc["command"]["value"], received_at, time.monotonic())
+                next_command = loop.time() + LEGACY_COMMAND_INTERVAL + self.jitter()
+
+    async def run_current(self, stop_at):
+        loop = asyncio.get_running_loop()
+        last_ingest = loop.time() - random.uniform(0, INGEST_INTERVAL)
+        while loop.time() < stop_at:
+            # UNO 每 reading_interval 秒送一筆數據，裝置在長輪詢期間先暫存
+            pending = min(INGEST_BATCH_SIZE, int((loop.time() - last_ingest) / self.args.reading_interval))
+            if pending > 0 and (pending >= INGEST_BATCH_SIZE or loop.time() - last_ingest >= INGEST_INTERVAL):
+                body = "".join(f"{self.mac},-{(pending - i) * self.args.reading_interval:.0f},"
+                               f"{random.uniform(20, 30):.1f},{random.uniform(40, 80):.1f},{random.uniform(20, 90):.0f},{random.uniform(0, 800):.0f}\n"
+                               for i in range(pending))
+                await self.client.request('POST', '/api/ingest', body, content_type='text/csv', label='POST /api/ingest')
+                last_ingest = loop.time()
+
+            status, payload = await self.client.request('GET', f'/api/wait_command/{self.mac}?timeout={LONG_POLL_TIMEOUT}',
+                                                        timeout=LONG_POLL_TIMEOUT + 5, label='GET /api/wait_command')
+            if status != 200:
+                await asyncio.sleep(COMMAND_RETRY_INTERVAL + self.jitter())
+                continue
+            doc = json.loads(payload)
+            if doc.get("has_command"):
+                received_at = time.monotonic()
+                await self.client.request('POST', f'/api/command_executed/{self.mac}', json.dumps({"seq": doc["last_seq"]}),
+                                          label='POST /api/command_executed')
+                acked_at = time.monotonic()
+                for command in doc["commands"]:
+                    self.stats.delivered(self.mac, command["value"], received_at, acked_at)
+
+
+async def send_commands(client, stats, macs, args, stop_at):
+    """
+    管理端：每 command_interval 秒對隨機一台裝置送出 set_threshold，value 唯一以便比對送達時間。
+    set_threshold 在送達前再次設定時伺服器只保留最新值，因此只選沒有未送達指令的裝置，
+    避免被取代的指令被誤算為未送達。
+    """
+    loop = asyncio.get_running_loop()
+    value = 0
+    # 等待裝置開機註冊完成
+    await asyncio.sleep(args.boot_spread + 1)
+    while loop.time() < stop_at - LONG_POLL_TIMEOUT - LEGACY_COMMAND_INTERVAL:
+        waiting = {mac for mac, _ in stats.issued}
+        idle = [mac for mac in macs if mac not in waiting]
+        if not idle:
+            await asyncio.sleep(args.command_interval)
+            continue
+        value += 1
+        mac = random.choice(idle)
+        stats.issued[(mac, value)] = time.monotonic()
+        await client.request('POST', '/api/set_threshold', json.dumps({"mac_address": mac, "case": 1, "value": value}),
+                             label='POST /api/set_threshold')
+        await asyncio.sleep(args.command_interval)
+
+
+async def run_phase(devices, args, run_id):
+    stats = Stats()
+    client = Client(args.url, stats)
+    macs = [f"SIM{run_id}{i:05X}" for i in range(devices)]
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    stop_at = started + args.boot_spread + args.duration
+    tasks = [VirtualDevice(mac, client, stats, args).run(stop_at) for mac in macs]
+    tasks.append(send_commands(client, stats, macs, args, stop_at))
+    await asyncio.gather(*tasks)
+    return stats, loop.time() - started
+
+
+def report(devices, stats, elapsed, args):
+    """
+    印出此裝置數量的結果，回傳是否超過 --max-error-rate 或 --max-p99。
+    """
+    total = sum(len(v) for v in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    print(f"\n== {devices} 台裝置（{args.firmware}），{elapsed:.0f} 秒，{total / elapsed:.1f} req/s，錯誤 {errors}/{total}")
+    print(f"{'endpoint':<34}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    saturated = False
+    for endpoint in sorted(stats.latencies):
+        latencies = stats.latencies[endpoint]
+        p50, p95, p99 = percentiles(latencies)
+        print(f"{endpoint:<34}{len(latencies):>8}{stats.errors[endpoint]:>8}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}")
+        # 長輪詢本來就會等到逾時，不列入尾端延遲判斷
+        if endpoint != 'GET /api/wait_command' and p99 > args.max_p99 * 1000:
+            saturated = True
+
+    issued = len(stats.delivery) + len(stats.issued)
+    if not issued:
+        print("警告：此階段沒有送出任何指令，無法量測指令送達延遲")
+    for label, values in (("指令送達", stats.delivery), ("指令完成", stats.round_trip)):
+        p50, p95, p99 = percentiles(values)
+        print(f"{label:<30}{len(values):>8}/{issued:<7}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}")
+    if total and errors / total > args.max_error_rate:
+        saturated = True
+    if stats.issued:
+        saturated = True
+    return saturated
+
+
+def serve(port, mode):
+    """
+    以 fake_gspread 與暫存資料庫啟動伺服器（--serve 的子程序；gevent 模式由呼叫端先完成 monkey patch）。
+    """
+    import logging
+    import tempfile
+    from flask import Flask
+    from flask_app import PlantModel, PlantController
+    from fake_gspread import FakeClient
+
+    workdir = tempfile.mkdtemp(prefix="plant-simulator-")
+    app = Flask(__name__, root_path=workdir, template_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+    model = PlantModel(app, db_url=f"sqlite:///{os.path.join(workdir, 'sim.db')}", client=FakeClient())
+    PlantController(app, model)
+    logging.disable(logging.INFO)
+    model.start_background()
+    if mode == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('127.0.0.1', port), app, log=None).serve_forever()
+    else:
+        app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def start_server(args):
+    port = urlsplit(args.url).port or 80
+    # gevent 的 monkey patch 必須在匯入其他模組之前執行
+    patch = "from gevent import monkey; monkey.patch_all(); " if args.serve == 'gevent' else ""
+    code = f"{patch}import device_simulator; device_simulator.serve({port}, {args.serve!r})"
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = Client(args.url, Stats(), timeout=1)
+    for _ in range(100):
+        status, _ = asyncio.run(client.request('GET', '/api/latest'))
+        if status == 200:
+            return process
+        time.sleep(0.2)
+    process.kill()
+    raise SystemExit(f"無法在連接埠 {port} 啟動伺服器")
+
+
+async def main(args):
+    run_id = f"{random.getrandbits(16):04X}"
+    for devices in args.devices:
+        stats, elapsed = await run_phase(devices, args, run_id)
+        run_id = f"{random.getrandbits(16):04X}"
+        if report(devices, stats, elapsed, args):
+            print(f"\n伺服器在 {devices} 台裝置時超過門檻（錯誤率 > {args.max_error_rate:.0%}、p99 > {args.max_p99}s 或指令未送達）。")
+            break
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="模擬 ESP8266 裝置群對伺服器施加負載")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="伺服器網址")
+    parser.add_argument('--devices', type=int, nargs='+', default=[10, 50, 100], help="依序測試的裝置數量")
+    parser.add_argument('--firmware', choices=['legacy', 'current'], default='current', help="模擬的韌體版本")
+    parser.add_argument('--duration', type=float, default=60, help="每個裝置數量的測試秒數（不含開機）")
+    parser.add_argument('--boot-spread', type=float, default=5, help="裝置開機註冊分散的秒數；0 為註冊風暴")
+    parser.add_argument('--jitter', type=float, default=0.5, help="每次輪詢間隔的隨機延遲上限（秒）")
+    parser.add_argument('--reading-interval', type=float, default=5, help="UNO 送出感測數據的間隔（秒）")
+    parser.add_argument('--command-interval', type=float, default=1, help="管理端送出 set_threshold 的間隔（秒）")
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help="錯誤率超過此值即視為超載")
+    parser.add_argument('--max-p99', type=float, default=2.0, help="非長輪詢端點的 p99 超過此秒數即視為超載")
+    parser.add_argument('--serve', choices=['threaded', 'gevent'], help="在子程序中以假的 Google Sheets 啟動伺服器")
+    args = parser.parse_args()
+    # 送出最後一個指令後，要保留一次長輪詢（或舊版韌體的輪詢間隔）的時間讓指令送達
+    min_duration = LONG_POLL_TIMEOUT + LEGACY_COMMAND_INTERVAL + 1
+    if args.duration <= min_duration:
+        parser.error(f"--duration 必須大於 {min_duration} 秒，才有時間送出並確認指令")
+
+    server = start_server(args) if args.serve else None
+    try:
+        asyncio.run(main(args))
+    finally:
+        if server is not None:
+            server.terminate()
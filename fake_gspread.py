@@ -0,0 +1,206 @@
+"""
+離線的 gspread 替身，供 benchmark.py 與本地測試使用，不需要 Google 帳號與金鑰。
+只實作 flask_app.py 用到的介面，並可模擬網路延遲與配額錯誤（HTTP 429）。
+
+    client = FakeClient(latency=0.2, quota_per_minute=60)
+    model = PlantModel(app, client=client)
+"""
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter, deque
+
+import requests
+import gspread.exceptions
+
+
+def api_error(code, status, message):
+    """
+    建立與真實 API 相同格式的 gspread APIError。
+    """
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({"error": {"code": code, "message": message, "status": status}}).encode()
+    return gspread.exceptions.APIError(response)
+
+
+def column_index(letters):
+    index = 0
+    for c in letters.upper():
+        index = index * 26 + ord(c) - ord('A') + 1
+    return index
+
+
+def parse_range(cell_range):
+    """
+    解析 "'工作表'!A2:E"、"工作表!A2:E10" 或 "工作表"，回傳 (名稱, 起始列, 結束列, 起始欄, 結束欄)；
+    未指定的列/欄為 None，列與欄皆從 1 開始。
+    """
+    if '!' in cell_range:
+        name, a1 = cell_range.rsplit('!', 1)
+    else:
+        name, a1 = cell_range, ''
+    if name.startswith("'") and name.endswith("'"):
+        name = name[1:-1].replace("''", "'")
+    bounds = []
+    for part in (a1.split(':') if a1 else []):
+        match = re.fullmatch(r'([A-Za-z]*)(\d*)', part)
+        if not match:
+            raise api_error(400, "INVALID_ARGUMENT", f"Unable to parse range: {cell_range}")
+        col, row = match.groups()
+        bounds.append((int(row) if row else None, column_index(col) if col else None))
+    start = bounds[0] if bounds else (None, None)
+    end = bounds[-1] if bounds else (None, None)
+    return name, start[0], end[0], start[1], end[1]
+
+
+def format_cell(value):
+    """
+    模擬 Sheets 預設的 FORMATTED_VALUE：讀回來的一律是字串，整數值的浮點數不帶小數點。
+    """
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class FakeClient:
+    """
+    latency/jitter：每次 API 呼叫的延遲秒數；quota_error_rate：隨機回傳 429 的機率；
+    quota_per_minute：每 60 秒最多允許的呼叫次數，超過時回傳 429（與真實配額相同的行為）。
+    calls 記錄每種 API 的呼叫次數。
+    """
+    def __init__(self, latency=0.0, jitter=0.0, quota_error_rate=0.0, quota_per_minute=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_error_rate = quota_error_rate
+        self.quota_per_minute = quota_per_minute
+        self.random = random.Random(seed)
+        self.spreadsheets = {}
+        self.calls = Counter()
+        self.quota_errors = 0
+        self.call_times = deque()
+        self.lock = threading.Lock()
+
+    def api_call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+            now = time.monotonic()
+            while self.call_times and now - self.call_times[0] >= 60:
+                self.call_times.popleft()
+            limited = self.quota_per_minute is not None and len(self.call_times) >= self.quota_per_minute
+            if limited or (self.quota_error_rate and self.random.random() < self.quota_error_rate):
+                self.quota_errors += 1
+                raise api_error(429, "RESOURCE_EXHAUSTED", "Quota exceeded for quota metric 'Read requests'")
+            self.call_times.append(now)
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def open_by_key(self, key):
+        self.api_call("open_by_key")
+        with self.lock:
+            if key not in self.spreadsheets:
+                self.spreadsheets[key] = FakeSpreadsheet(self, key)
+            return self.spreadsheets[key]
+
+    def seed_worksheet(self, key, title, rows):
+        """
+        不經過延遲與配額，直接建立工作表並填入資料（供 benchmark 準備資料）。
+        """
+        with self.lock:
+            sheet = self.spreadsheets.setdefault(key, FakeSpreadsheet(self, key))
+        worksheet = sheet.worksheets_by_title.get(title) or FakeWorksheet(sheet, title)
+        worksheet.rows = [[format_cell(v) for v in row] for row in rows]
+        worksheet.row_count = max(worksheet.row_count, len(worksheet.rows))
+        sheet.worksheets_by_title[title] = worksheet
+        return worksheet
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, key):
+        self.client = client
+        self.id = key
+        self.worksheets_by_title = {}
+
+    def fetch_sheet_metadata(self, params=None):
+        self.client.api_call("fetch_sheet_metadata")
+        return {"spreadsheetId": self.id, "sheets": [
+            {"properties": {"title": ws.title, "gridProperties": {"rowCount": ws.row_count, "columnCount": ws.col_count}}}
+            for ws in self.worksheets_by_title.values()
+        ]}
+
+    def worksheets(self):
+        self.client.api_call("fetch_sheet_metadata")
+        return list(self.worksheets_by_title.values())
+
+    def worksheet(self, title):
+        self.client.api_call("fetch_sheet_metadata")
+        if title not in self.worksheets_by_title:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets_by_title[title]
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        self.client.api_call("batch_update")
+        if title in self.worksheets_by_title:
+            raise api_error(400, "INVALID_ARGUMENT", f'A sheet with the name "{title}" already exists.')
+        worksheet = FakeWorksheet(self, title, int(rows), int(cols))
+        self.worksheets_by_title[title] = worksheet
+        return worksheet
+
+    def del_worksheet(self, worksheet):
+        self.client.api_call("batch_update")
+        if self.worksheets_by_title.pop(worksheet.title, None) is None:
+            raise api_error(400, "INVALID_ARGUMENT", f"No sheet with id: {worksheet.title}")
+
+    def read_range(self, cell_range):
+        name, start_row, end_row, start_col, end_col = parse_range(cell_range)
+        if name not in self.worksheets_by_title:
+            raise api_error(400, "INVALID_ARGUMENT", f"Unable to parse range: {cell_range}")
+        rows = self.worksheets_by_title[name].rows
+        rows = rows[(start_row or 1) - 1:end_row]
+        rows = [row[(start_col or 1) - 1:end_col] for row in rows]
+        # 與真實 API 相同：省略列尾空白儲存格，沒有資料時不回傳 values
+        rows = [row[:max((i + 1 for i, v in enumerate(row) if v != ''), default=0)] for row in rows]
+        while rows and not rows[-1]:
+            rows.pop()
+        value_range = {"range": cell_range, "majorDimension": "ROWS"}
+        if rows:
+            value_range["values"] = rows
+        return value_range
+
+    def values_get(self, cell_range, params=None):
+        self.client.api_call("values_get")
+        return self.read_range(cell_range)
+
+    def values_batch_get(self, ranges, params=None):
+        self.client.api_call("values_batch_get")
+        # 任一範圍無效時整批失敗
+        return {"spreadsheetId": self.id, "valueRanges": [self.read_range(r) for r in ranges]}
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, rows=1000, cols=26):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows = []
+        self.row_count = rows
+        self.col_count = cols
+
+    def insert_row(self, values, index=1, value_input_option='RAW'):
+        self.spreadsheet.client.api_call("insert_row")
+        self.rows.insert(index - 1, [format_cell(v) for v in values])
+        self.row_count = max(self.row_count, len(self.rows))
+
+    def append_rows(self, values, value_input_option='RAW', **kwargs):
+        self.spreadsheet.client.api_call("append_rows")
+        self.rows.extend([format_cell(v) for v in row] for row in values)
+        self.row_count = max(self.row_count, len(self.rows))
+
+    def append_row(self, values, value_input_option='RAW', **kwargs):
+        self.append_rows([values], value_input_option=value_input_option)
+
+    def get_all_values(self):
+        self.spreadsheet.client.api_call("values_get")
+        return [list(row) for row in self.rows]
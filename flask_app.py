@@ -1,41 +1,1491 @@
+import io
 import os
+import csv
+import sys
+import zlib
+import json
+import math
+import time
+import heapq
+import shutil
+import uuid
+import hashlib
+import tempfile
 import logging
-from datetime import datetime
+import threading
+import importlib.util
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-import pandas as pd
-from flask import Flask, jsonify, request, render_template, redirect, url_for
+from flask import Flask, jsonify, request, render_template, redirect, url_for, g, has_request_context, Response, send_from_directory, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 import pytz
 
-import gspread
-import gspread.exceptions
-from google.oauth2 import service_account
+
+_import_lock = threading.RLock()
+
+
+class LazyModule:
+    """
+    第一次存取屬性時才匯入的模組。匯入在 _import_lock 內進行：多個執行緒同時第一次使用時，
+    只有一個執行緒匯入，其他等待匯入完成（importlib 的 LazyLoader 在 Python 3.11 同時存取時會看到未初始化完成的模組）。
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _import_lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+
+def lazy_import(name, optional=False):
+    """
+    回傳第一次存取屬性時才匯入的模組。optional=True 時，未安裝的模組回傳 None。
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except ModuleNotFoundError:
+        spec = None
+    if spec is None:
+        if optional:
+            return None
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    return LazyModule(name)
+
+
+# pandas、gspread 與 google-auth 延遲到第一次使用時才載入，
+# 讓只讀寫 SQLite 的裝置 API（例如 /api/get_command）在啟動後立即可用
+pd = lazy_import('pandas')
+gspread = lazy_import('gspread')
+service_account = lazy_import('google.oauth2.service_account')
+
+# 未安裝 pyarrow 時停用 Parquet 封存（pyarrow.parquet 在讀寫時才匯入）
+pa = lazy_import('pyarrow', optional=True)
+
+# 未安裝 Pillow 時不產生縮圖，直接使用原圖
+Image = lazy_import('PIL.Image', optional=True)
+ImageOps = lazy_import('PIL.ImageOps', optional=True)
+
+
+def run_blocking(fn, *args):
+    """
+    執行會佔用 CPU 或阻塞的背景工作（pandas、Pillow、等待 SQLite 鎖）。
+    以 gevent monkey patch 啟動時（server.py、gunicorn -k gevent），threading 的執行緒其實是同一個 hub 上的協程，
+    直接執行會卡住所有長輪詢與請求，因此改在 gevent 的原生執行緒池執行；其他情況直接呼叫。
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+
+TAIPEI_TZ = pytz.timezone('Asia/Taipei')
+SHEET_TIME_FORMAT = "%Y/%m/%d-%H:%M:%S"
+# Google Sheets 欄位名稱 -> 本地資料表 sensor_readings 欄位名稱
+SENSOR_COLUMNS = {
+    "環境溫度": "temperature",
+    "環境濕度": "humidity",
+    "土壤濕度": "soil_moisture",
+    "光照度": "light",
+}
+SHEET_HEADERS = ["時間", *SENSOR_COLUMNS]
+# 上傳照片：以內容的 SHA-256 命名（/uploads/<hash>.<ext>），另產生縮圖版本 /uploads/<hash>.<variant>.jpg（最長邊像素）
+PHOTO_URL_PREFIX = "/uploads/"
+PHOTO_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp"}
+PHOTO_VARIANTS = {"thumb": 160, "card": 480}
+# /api/overview 對本地沒有數據的植物，只讀取工作表最後幾列
+SHEET_TAIL_ROWS = 20
+# 設定類指令（1: 土壤濕度閾值、2: 光照閾值、4: 自動澆水開關）在送達前再次設定時，只保留最新值
+SETTING_CASES = {1, 2, 4}
+# /api/ingest 接受的量測時間：2000-01-01 之後，且最多比伺服器時間晚一天（裝置時鐘誤差）
+INGEST_MIN_TS = 946684800
+INGEST_MAX_FUTURE = 86400
+# /api/export 每批讀取的筆數
+EXPORT_CHUNK_ROWS = 5000
+# pandas 版本的分組方式，用於 Parquet 封存的數據（輸入為台北時間的 DatetimeIndex 元件）
+BUCKET_ACCESSORS = {
+    "hour": lambda t: t.dt.hour,
+    "weekday": lambda t: t.dt.weekday,
+    "day": lambda t: t.dt.day,
+    "month": lambda t: t.dt.month,
+}
+# 彙總表：每株植物、每個數值欄位每小時與每日（台北時間）的 sum/min/max/count，
+# 由 sensor_readings 的 AFTER INSERT 觸發器增量維護；bucket_ts 為該小時/該日開始的 UTC epoch 秒數
+TAIPEI_OFFSET = 8 * 3600
+ROLLUP_TABLES = {"day": ("rollup_daily", 86400), "hour": ("rollup_hourly", 3600)}
+# 各分組方式可使用的彙總表（由粗到細）；每小時的分組無法由每日彙總計算
+BUCKET_ROLLUPS = {"hour": ["hour"], "weekday": ["day", "hour"], "day": ["day", "hour"], "month": ["day", "hour"]}
+# 聚合模式的分組方式（以台北時間計算，台北無日光節約時間，固定 +8 小時）
+# weekday 以週一為 0，與 history.html 的週檢視一致
+_LOCAL_TIME = "ts, 'unixepoch', '+8 hours'"
+BUCKET_EXPRESSIONS = {
+    "hour": f"CAST(strftime('%H', {_LOCAL_TIME}) AS INTEGER)",
+    "weekday": f"(CAST(strftime('%w', {_LOCAL_TIME}) AS INTEGER) + 6) % 7",
+    "day": f"CAST(strftime('%d', {_LOCAL_TIME}) AS INTEGER)",
+    "month": f"CAST(strftime('%m', {_LOCAL_TIME}) AS INTEGER)",
+}
+
+
+# -----------------------------
+# 效能指標
+# -----------------------------
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, metrics, name, phase, labels):
+        self.metrics = metrics
+        self.name = name
+        self.phase = phase
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        self.metrics.observe(self.name, elapsed, **self.labels)
+        if self.phase:
+            self.metrics.add_phase(self.phase, elapsed)
+        return False
+
+
+class Metrics:
+    """
+    輕量的 Prometheus 格式指標：counter、histogram，以及在 /metrics 被讀取時才計算的 gauge 與 counter
+    （例如由其他物件自行累計的次數）。
+    enabled=False 時所有記錄方法立即返回，timer() 回傳共用的空 context manager。
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [各分組次數..., sum, count]
+        self._buckets = {}
+        self._help = {}
+        self._gauges = {}      # name -> callback，回傳 [(labels dict, value)]；gauge 或讀取時才計算的 counter
+
+    def describe(self, name, kind, help_text, buckets=LATENCY_BUCKETS):
+        self._help[name] = (kind, help_text)
+        if kind == "histogram":
+            self._buckets[name] = buckets
+
+    def gauge(self, name, help_text, callback, kind="gauge"):
+        """
+        callback 在 /metrics 被讀取時呼叫；kind="counter" 用於只會遞增、由其他物件累計的次數。
+        """
+        self._help[name] = (kind, help_text)
+        self._gauges[name] = callback
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = self._buckets.get(name, LATENCY_BUCKETS)
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def timer(self, name, phase=None, **labels):
+        """
+        量測區塊耗時；指定 phase 時同時累計到目前請求的 Server-Timing（例如 db、sheets、json）。
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, phase, labels)
+
+    def add_phase(self, phase, elapsed):
+        if has_request_context() and "server_timing" in g:
+            g.server_timing[phase] = g.server_timing.get(phase, 0) + elapsed
+
+    def render(self):
+        """
+        輸出 Prometheus text exposition format。
+        """
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def fmt(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+
+        lines = []
+        by_name = {}
+        for (name, labels), value in sorted(counters.items()):
+            by_name.setdefault(name, []).append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), values in sorted(histograms.items()):
+            buckets = self._buckets.get(name, LATENCY_BUCKETS)
+            series = by_name.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(buckets, values):
+                cumulative += count
+                series.append(f"{name}_bucket{fmt(labels + (('le', bound),))} {cumulative}")
+            series.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {values[-1]}")
+            series.append(f"{name}_sum{fmt(labels)} {values[-2]}")
+            series.append(f"{name}_count{fmt(labels)} {values[-1]}")
+        for name, callback in self._gauges.items():
+            try:
+                by_name[name] = [f"{name}{fmt(tuple(sorted(labels.items())))} {value}" for labels, value in callback()]
+            except Exception as e:
+                logging.error(f"計算指標 {name} 失敗: {e}")
+
+        for name in sorted(by_name):
+            kind, help_text = self._help.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(by_name[name])
+        return "\n".join(lines) + "\n"
+
+
+# -----------------------------
+# 快取
+# -----------------------------
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    執行緒安全的 TTL + LRU 快取。
+    除了 max_entries 之外，另以 max_cost（例如快取內的資料總筆數）限制記憶體用量。
+    get_or_load 載入期間若有 invalidate，載入的結果可能已過時，不會寫入快取。
+    """
+    def __init__(self, ttl=30, max_entries=256, max_cost=500000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_cost = max_cost
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, cost, value)
+        self._cost = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, cost=1):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if cost > self.max_cost:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, cost, value)
+            self._cost += cost
+            while len(self._entries) > self.max_entries or self._cost > self.max_cost:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_load(self, key, loader, cost=len):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            generation = self._generation
+            value = loader()
+            with self._lock:
+                stale = generation != self._generation
+            if not stale:
+                self.set(key, value, cost=cost(value))
+        return value
+
+    def invalidate(self, predicate=None):
+        """
+        移除符合 predicate(key) 的項目；未指定時清空整個快取。
+        """
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._entries if predicate is None or predicate(k)]:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "cost": self._cost,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key):
+        _, cost, _ = self._entries.pop(key)
+        self._cost -= cost
+
+
+# -----------------------------
+# 裝置通知
+# -----------------------------
+class DeviceNotifier:
+    """
+    讓長輪詢請求等待特定裝置的新指令或重設。
+    每個等待中的請求只持有一個 Event；以 server.py（gevent）啟動時，
+    threading 會被替換為協程版本，數千個閒置的等待不需要各佔一個執行緒。
+    """
+    def __init__(self):
+        self._waiters = {}  # mac_address -> set(Event)
+        self._lock = threading.Lock()
+
+    def subscribe(self, mac_address):
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(mac_address, set()).add(event)
+        return event
+
+    def unsubscribe(self, mac_address, event):
+        with self._lock:
+            waiters = self._waiters.get(mac_address)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[mac_address]
+
+    def notify(self, mac_address):
+        with self._lock:
+            waiters = list(self._waiters.get(mac_address, ()))
+        for event in waiters:
+            event.set()
+
+    def waiting_count(self):
+        with self._lock:
+            return sum(len(w) for w in self._waiters.values())
+
+
+# -----------------------------
+# 植物索引
+# -----------------------------
+class PlantRegistry:
+    """
+    plants 資料表的記憶體索引（依 id 與 mac_address），新增/更新/刪除時同步更新，
+    讓裝置每次輪詢的查詢不需要讀取磁碟。
+    """
+    def __init__(self):
+        self._by_id = {}
+        self._by_mac = {}
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        with self._lock:
+            self._by_id = {row.id: row for row in rows}
+            self._by_mac = {row.mac_address: row for row in rows if row.mac_address}
+
+    def put(self, row):
+        with self._lock:
+            old = self._by_id.get(row.id)
+            if old is not None and old.mac_address != row.mac_address:
+                self._by_mac.pop(old.mac_address, None)
+            self._by_id[row.id] = row
+            if row.mac_address:
+                self._by_mac[row.mac_address] = row
+
+    def remove(self, plant_id):
+        with self._lock:
+            row = self._by_id.pop(plant_id, None)
+            if row is not None:
+                self._by_mac.pop(row.mac_address, None)
+
+    def by_id(self, plant_id):
+        try:
+            return self._by_id.get(int(plant_id))
+        except (TypeError, ValueError):
+            return None
+
+    def by_mac(self, mac_address):
+        return self._by_mac.get(mac_address)
+
+    def all(self):
+        with self._lock:
+            return sorted(self._by_id.values(), key=lambda row: row.id, reverse=True)
+
+
+# -----------------------------
+# 滾動統計
+# -----------------------------
+class RollingWindow:
+    """
+    以固定容量的環形緩衝區（array，每筆 16 bytes）保存最近 size 筆、且不早於最新一筆 span 秒的數值。
+    平均值與斜率以累加和維護，最小/最大值以單調佇列維護，每次 push 為攤銷 O(1)。
+    時間 x 以 origin 為基準並每 size 次 push 重新計算累加和，避免平方和累積浮點誤差。
+    """
+    __slots__ = ("size", "span", "ts", "values", "start", "end", "origin", "pushes",
+                 "sum_x", "sum_y", "sum_xx", "sum_xy", "min_queue", "max_queue")
+
+    def __init__(self, size=60, span=3600):
+        self.size = size
+        self.span = span
+        self.ts = array('d', [0.0]) * size
+        self.values = array('d', [0.0]) * size
+        self.start = self.end = 0  # 最舊一筆與下一筆的絕對位置，索引為 position % size
+        self.min_queue = deque()   # 絕對位置，對應數值遞增
+        self.max_queue = deque()   # 絕對位置，對應數值遞減
+        self.reset_sums(None)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reset_sums(self, origin):
+        self.origin = origin
+        self.pushes = 0
+        self.sum_x = self.sum_y = self.sum_xx = self.sum_xy = 0.0
+
+    def push(self, ts, value):
+        """
+        加入一筆數據；不晚於目前最新一筆的數據會被忽略，回傳是否加入。
+        """
+        if len(self) and ts <= self.last_ts:
+            return False
+        while len(self) == self.size or (len(self) and self.ts[self.start % self.size] < ts - self.span):
+            self.evict()
+        if not len(self):
+            self.reset_sums(ts)
+
+        i = self.end % self.size
+        self.ts[i] = ts
+        self.values[i] = value
+        while self.min_queue and self.values[self.min_queue[-1] % self.size] >= value:
+            self.min_queue.pop()
+        self.min_queue.append(self.end)
+        while self.max_queue and self.values[self.max_queue[-1] % self.size] <= value:
+            self.max_queue.pop()
+        self.max_queue.append(self.end)
+        self.end += 1
+
+        x = ts - self.origin
+        self.sum_x += x
+        self.sum_y += value
+        self.sum_xx += x * x
+        self.sum_xy += x * value
+        self.pushes += 1
+        if self.pushes >= self.size:
+            self.rebase()
+        return True
+
+    def evict(self):
+        i = self.start % self.size
+        x = self.ts[i] - self.origin
+        value = self.values[i]
+        self.sum_x -= x
+        self.sum_y -= value
+        self.sum_xx -= x * x
+        self.sum_xy -= x * value
+        if self.min_queue[0] == self.start:
+            self.min_queue.popleft()
+        if self.max_queue[0] == self.start:
+            self.max_queue.popleft()
+        self.start += 1
+
+    def rebase(self):
+        """
+        以最舊一筆為新的時間基準重新計算累加和（每 size 次 push 一次，攤銷後仍為 O(1)）。
+        """
+        self.reset_sums(self.ts[self.start % self.size])
+        for position in range(self.start, self.end):
+            x = self.ts[position % self.size] - self.origin
+            value = self.values[position % self.size]
+            self.sum_x += x
+            self.sum_y += value
+            self.sum_xx += x * x
+            self.sum_xy += x * value
+
+    @property
+    def last_ts(self):
+        return self.ts[(self.end - 1) % self.size] if len(self) else None
+
+    @property
+    def last(self):
+        return self.values[(self.end - 1) % self.size] if len(self) else None
+
+    @property
+    def mean(self):
+        return self.sum_y / len(self) if len(self) else None
+
+    @property
+    def minimum(self):
+        return self.values[self.min_queue[0] % self.size] if len(self) else None
+
+    @property
+    def maximum(self):
+        return self.values[self.max_queue[0] % self.size] if len(self) else None
+
+    @property
+    def slope(self):
+        """
+        最小平方法的斜率（每秒變化量）；少於兩筆時為 None。
+        """
+        n = len(self)
+        denominator = n * self.sum_xx - self.sum_x * self.sum_x
+        if n < 2 or denominator <= 0:
+            return None
+        return (n * self.sum_xy - self.sum_x * self.sum_y) / denominator
+
+    def summary(self):
+        slope = self.slope
+        return {
+            "count": len(self),
+            "last": self.last,
+            "mean": self.mean,
+            "min": self.minimum,
+            "max": self.maximum,
+            "slope_per_hour": slope * 3600 if slope is not None else None,
+            "since": datetime.fromtimestamp(self.ts[self.start % self.size], tz=timezone.utc) if len(self) else None,
+        }
+
+
+class RollingStats:
+    """
+    每台裝置、每個數值欄位一個 RollingWindow，由新寫入的數據增量更新。
+    每批數據只需要處理最後 size 筆（更早的數據加入後也會立即被移出視窗），成本與歷史長度無關。
+    """
+    def __init__(self, size=60, span=3600):
+        self.size = size
+        self.span = span
+        self.lock = threading.Lock()
+        self._windows = {}  # mac_address -> {欄位: RollingWindow}
+
+    def __contains__(self, mac_address):
+        return mac_address in self._windows
+
+    def update(self, mac_address, readings):
+        """
+        readings 為含 ts 與數值欄位的 dict（或資料列 mapping）；缺值（None 或 NaN）不加入對應欄位的視窗。
+        """
+        columns = list(SENSOR_COLUMNS.values())
+        tail = sorted(heapq.nlargest(self.size, readings, key=lambda r: r["ts"]), key=lambda r: r["ts"])
+        with self.lock:
+            windows = self._windows.get(mac_address)
+            if windows is None:
+                windows = self._windows[mac_address] = {col: RollingWindow(self.size, self.span) for col in columns}
+            for reading in tail:
+                for col in columns:
+                    value = reading[col]
+                    if value is not None and value == value:
+                        windows[col].push(float(reading["ts"]), float(value))
+
+    def window(self, mac_address, column):
+        windows = self._windows.get(mac_address)
+        return windows[column] if windows is not None else None
+
+    def forget(self, mac_address):
+        with self.lock:
+            self._windows.pop(mac_address, None)
+
+    def summary(self, mac_address):
+        with self.lock:
+            windows = self._windows.get(mac_address)
+            if windows is None or not any(len(w) for w in windows.values()):
+                return None
+            return {sheet_col: windows[col].summary() for sheet_col, col in SENSOR_COLUMNS.items()}
+
+
+# -----------------------------
+# 背景工作
+# -----------------------------
+class RetryLater(Exception):
+    """
+    背景工作暫時無法執行（例如 Google 授權失敗仍在冷卻中）：delay 秒後再執行，不計入重試次數。
+    """
+    def __init__(self, message, delay):
+        super().__init__(message)
+        self.delay = delay
+
+
+class JobExecutor:
+    """
+    以有上限的執行緒池執行耗時的 Google Sheets 操作，讓 API 在本地資料庫提交後即可回應。
+    工作記錄在 jobs 資料表；失敗時以指數退避重試，重新啟動後由 resume() 繼續未完成的工作。
+    同一個 key（例如 MAC 位址）的工作不會同時執行：key 正在執行時重新排入佇列稍後再試，不佔用執行緒等待。handler 拋出 RetryLater 時延後執行，不計入重試次數。
+    handler 經由 run_blocking 執行，在 gevent 伺服器中不會阻塞其他請求。
+    多個程序共用資料庫時，每個工作只會由一個程序認領（jobs.owner），
+    所屬程序已停止的工作由其他程序每 recover_interval 秒檢查並接手。
+    """
+    def __init__(self, engine, max_workers=4, max_attempts=5, base_delay=2, max_delay=300, shared_state=None, recover_interval=60,
+                 key_busy_delay=1):
+        self.engine = engine
+        self.shared = shared_state or LocalSharedState()
+        self.recover_interval = recover_interval
+        self.key_busy_delay = key_busy_delay
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.handlers = {}
+        self._schedule = []  # heap of (run_at, job_id)
+        self._cond = threading.Condition()
+        self._running_keys = set()
+        self._pool = None
+        self._dispatcher = None
+        self._recovery = None
+        self.init_db()
+
+    def init_db(self):
+        with self.engine.connect() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    job_key TEXT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    run_after INTEGER NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    updated_at INTEGER NOT NULL
+                );
+            """))
+            # 升級既有資料庫：owner 記錄認領工作的程序
+            columns = [r.name for r in conn.execute(text("PRAGMA table_info(jobs)"))]
+            if "owner" not in columns:
+                conn.execute(text("ALTER TABLE jobs ADD COLUMN owner TEXT"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, run_after);"))
+            conn.commit()
+
+    def register(self, kind, handler):
+        """
+        handler(payload) 發生例外即視為失敗並重試。
+        """
+        self.handlers[kind] = handler
+
+    def start(self):
+        with self._cond:
+            if self._dispatcher is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+                self._dispatcher = threading.Thread(target=self._dispatch, name="job-dispatcher", daemon=True)
+                self._dispatcher.start()
+
+    def submit(self, kind, payload, key=None):
+        now = int(time.time())
+        with self.engine.begin() as conn:
+            result = conn.execute(text("""
+                INSERT INTO jobs (kind, job_key, payload, run_after, created_at, updated_at)
+                VALUES (:kind, :job_key, :payload, :now, :now, :now)
+            """), {"kind": kind, "job_key": key, "payload": json.dumps(payload), "now": now})
+        job_id = result.lastrowid
+        self.start()
+        self._enqueue(job_id, now)
+        return job_id
+
+    def resume(self):
+        """
+        重新排程未完成（pending 或執行中被中斷）的工作，只接手尚未認領或所屬程序已停止的工作。
+        之後每 recover_interval 秒再檢查一次，接手其他已停止程序留下的工作。
+        """
+        live = self.shared.live_owners()
+        with self.engine.begin() as conn:
+            rows = conn.execute(text("SELECT id, status, owner, run_after FROM jobs WHERE status IN ('pending', 'running') ORDER BY id")).all()
+            orphans = [row for row in rows if row.owner is None or row.owner not in live]
+            # 以原本的狀態與 owner 為條件接手，多個程序同時檢查時只有一個會成功
+            rows = [row for row in orphans if conn.execute(text("""
+                UPDATE jobs SET status = 'pending', owner = :owner
+                WHERE id = :id AND status = :status AND owner IS :old_owner
+            """), {"owner": self.shared.owner, "id": row.id, "status": row.status, "old_owner": row.owner}).rowcount]
+        if rows:
+            self.start()
+            for row in rows:
+                self._enqueue(row.id, row.run_after)
+            logging.info(f"已重新排程 {len(rows)} 個未完成的背景工作。")
+        with self._cond:
+            if self._recovery is None:
+                self._recovery = threading.Thread(target=self._recover, name="job-recovery", daemon=True)
+                self._recovery.start()
+
+    def get(self, job_id):
+        with self.engine.connect() as conn:
+            row = conn.execute(text("SELECT * FROM jobs WHERE id=:id"), {"id": job_id}).mappings().first()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def latest(self, kind, key):
+        """
+        回傳同一個 kind 與 key 最近送出的工作，沒有時回傳 None。
+        """
+        with self.engine.connect() as conn:
+            row = conn.execute(text("SELECT id FROM jobs WHERE kind=:kind AND job_key=:job_key ORDER BY id DESC LIMIT 1"),
+                               {"kind": kind, "job_key": key}).first()
+        return None if row is None else self.get(row.id)
+
+    def _recover(self):
+        while True:
+            time.sleep(self.recover_interval)
+            try:
+                self.resume()
+            except Exception as e:
+                logging.error(f"檢查中斷的背景工作失敗: {e}")
+
+    def _enqueue(self, job_id, run_at):
+        with self._cond:
+            heapq.heappush(self._schedule, (run_at, job_id))
+            self._cond.notify()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._schedule or self._schedule[0][0] > time.time():
+                    timeout = self._schedule[0][0] - time.time() if self._schedule else None
+                    self._cond.wait(timeout)
+                _, job_id = heapq.heappop(self._schedule)
+            try:
+                self._pool.submit(self._run, job_id)
+            except RuntimeError:
+                # 直譯器結束中，執行緒池不再接受工作；未執行的工作由下次 resume() 繼續
+                return
+
+    def _run(self, job_id):
+        job = self.get(job_id)
+        if job is None or job["status"] != 'pending':
+            return
+        key = job["job_key"]
+        if key is not None:
+            with self._cond:
+                busy = key in self._running_keys
+                self._running_keys.add(key)
+            if busy:
+                # 同一個 key 的工作正在執行，稍後再排程
+                self._enqueue(job_id, time.time() + self.key_busy_delay)
+                return
+        try:
+            self._run_claimed(job_id, job)
+        finally:
+            if key is not None:
+                with self._cond:
+                    self._running_keys.discard(key)
+
+    def _run_claimed(self, job_id, job):
+        # 以條件式更新認領工作：同一個工作被多個程序排程時只有一個會執行
+        with self.engine.begin() as conn:
+            claimed = conn.execute(text("""
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, owner = :owner, updated_at = :now
+                WHERE id = :id AND status = 'pending' AND run_after <= :now
+            """), {"owner": self.shared.owner, "now": int(time.time()), "id": job_id}).rowcount
+        if not claimed:
+            return
+        try:
+            run_blocking(self.handlers[job["kind"]], job["payload"])
+        except RetryLater as e:
+            run_after = math.ceil(time.time() + e.delay)
+            self._update(job_id, status='pending', attempts=job["attempts"], last_error=str(e), run_after=run_after)
+            logging.info(f"背景工作 {job_id} ({job['kind']}) 延後 {e.delay:.0f} 秒執行: {e}")
+            self._enqueue(job_id, run_after)
+            return
+        except Exception as e:
+            attempts = job["attempts"] + 1
+            if attempts >= self.max_attempts:
+                self._update(job_id, status='failed', last_error=str(e))
+                logging.error(f"背景工作 {job_id} ({job['kind']}) 失敗，已放棄: {e}")
+                return
+            delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+            run_after = math.ceil(time.time() + delay)
+            self._update(job_id, status='pending', last_error=str(e), run_after=run_after)
+            logging.warning(f"背景工作 {job_id} ({job['kind']}) 失敗，{delay} 秒後重試: {e}")
+            self._enqueue(job_id, run_after)
+            return
+        self._update(job_id, status='succeeded', last_error=None)
+        logging.info(f"背景工作 {job_id} ({job['kind']}) 完成。")
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = int(time.time())
+        assignments = ", ".join(f"{name} = :{name}" for name in fields)
+        with self.engine.begin() as conn:
+            conn.execute(text(f"UPDATE jobs SET {assignments} WHERE id = :id"), {**fields, "id": job_id})
+
+
+# -----------------------------
+# 多程序共享狀態
+# -----------------------------
+class SharedState(ABC):
+    """
+    多個 WSGI worker 程序之間的協調介面：
+    - publish/subscribe：廣播「某個 key 已變更」的事件（例如植物資料、感測數據、裝置指令），
+      其他程序據此讓快取失效或喚醒長輪詢；發出事件的程序不會收到自己的事件
+    - acquire_lease：只讓一個程序執行某項背景工作（例如鏡像到 Google Sheets），持有者停止續約後由其他程序接手
+    - live_owners：目前仍在運作的程序，用於判斷中斷的背景工作
+    預設的 LocalSharedState 只適用於單一程序；多個 worker 時使用 SQLiteSharedState 或自行實作此介面。
+    """
+    def __init__(self):
+        self.owner = uuid.uuid4().hex
+        self._subscribers = {}
+
+    def subscribe(self, topic, callback):
+        self._subscribers.setdefault(topic, []).append(callback)
+
+    def dispatch(self, topic, key):
+        for callback in self._subscribers.get(topic, []):
+            try:
+                callback(key)
+            except Exception as e:
+                logging.error(f"處理共享事件 {topic}:{key} 失敗: {e}")
+
+    @abstractmethod
+    def publish(self, topic, key, conn=None):
+        """
+        通知其他程序 topic 的 key 已變更；傳入 conn 時與呼叫端的寫入在同一個交易中送出。
+        """
+
+    @abstractmethod
+    def acquire_lease(self, name, ttl):
+        """
+        取得或續約 name 的租約（ttl 秒），回傳本程序是否持有。
+        """
+
+    @abstractmethod
+    def release_lease(self, name):
+        """
+        釋放本程序持有的租約。
+        """
+
+    @abstractmethod
+    def live_owners(self):
+        """
+        回傳目前仍在運作的程序 owner 集合。
+        """
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class LocalSharedState(SharedState):
+    """
+    單一程序：事件只在本程序內發生，不需要轉送；租約永遠由本程序持有。
+    """
+    def publish(self, topic, key, conn=None):
+        pass
+
+    def acquire_lease(self, name, ttl):
+        return True
+
+    def release_lease(self, name):
+        pass
+
+    def live_owners(self):
+        return {self.owner}
+
+
+class SQLiteSharedState(SharedState):
+    """
+    以共用的 SQLite 資料庫在程序之間傳遞事件與租約。
+    每個程序的背景執行緒每 poll_interval 秒讀取新事件並分派給訂閱者，同時更新本程序的存活租約。
+    """
+    def __init__(self, engine, poll_interval=0.5, heartbeat_ttl=30, event_retention=300):
+        super().__init__()
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.heartbeat_ttl = heartbeat_ttl
+        self.event_retention = event_retention
+        self._last_event_id = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.init_db()
+
+    def init_db(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS shared_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    topic TEXT NOT NULL,
+                    event_key TEXT NOT NULL,
+                    origin TEXT NOT NULL,
+                    created_at INTEGER NOT NULL
+                );
+            """))
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS shared_leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+            """))
+
+    def publish(self, topic, key, conn=None):
+        """
+        傳入 conn 時與呼叫端的寫入在同一個交易中提交（SQLite 同時只能有一個寫入交易）。
+        """
+        if conn is None:
+            with self.engine.begin() as conn:
+                return self.publish(topic, key, conn)
+        conn.execute(text("INSERT INTO shared_events (topic, event_key, origin, created_at) VALUES (:topic, :key, :origin, :now)"),
+                     {"topic": topic, "key": str(key), "origin": self.owner, "now": int(time.time())})
+
+    def acquire_lease(self, name, ttl):
+        """
+        取得或續約租約，回傳本程序是否持有。
+        """
+        now = time.time()
+        with self.engine.begin() as conn:
+            result = conn.execute(text("""
+                INSERT INTO shared_leases (name, owner, expires_at) VALUES (:name, :owner, :expires_at)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE shared_leases.owner = excluded.owner OR shared_leases.expires_at < :now
+            """), {"name": name, "owner": self.owner, "expires_at": now + ttl, "now": now})
+        return result.rowcount > 0
+
+    def release_lease(self, name):
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM shared_leases WHERE name=:name AND owner=:owner"), {"name": name, "owner": self.owner})
+
+    def live_owners(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("SELECT owner FROM shared_leases WHERE name LIKE 'process:%' AND expires_at >= :now"),
+                                {"now": time.time()}).all()
+        return {row.owner for row in rows} | {self.owner}
+
+    def start(self):
+        if self._thread is None:
+            with self.engine.connect() as conn:
+                self._last_event_id = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM shared_events")).scalar()
+            self.acquire_lease(f"process:{self.owner}", self.heartbeat_ttl)
+            self._thread = threading.Thread(target=self.run, name="shared-state", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.release_lease(f"process:{self.owner}")
+
+    def run(self):
+        next_heartbeat = next_prune = time.monotonic()
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+                now = time.monotonic()
+                if now >= next_heartbeat:
+                    self.acquire_lease(f"process:{self.owner}", self.heartbeat_ttl)
+                    next_heartbeat = now + self.heartbeat_ttl / 3
+                if now >= next_prune:
+                    self.prune()
+                    next_prune = now + 60
+            except Exception as e:
+                logging.error(f"讀取共享事件失敗: {e}")
+
+    def poll(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("SELECT id, topic, event_key, origin FROM shared_events WHERE id > :last_id ORDER BY id"),
+                                {"last_id": self._last_event_id}).all()
+        for row in rows:
+            self._last_event_id = row.id
+            if row.origin != self.owner:
+                self.dispatch(row.topic, row.event_key)
+
+    def prune(self):
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM shared_events WHERE created_at < :before"), {"before": int(now - self.event_retention)})
+            conn.execute(text("DELETE FROM shared_leases WHERE expires_at < :before"), {"before": now - self.event_retention})
+
+
+# -----------------------------
+# Parquet 封存
+# -----------------------------
+def month_start_ts(year, month):
+    """
+    台北時間某月 1 日 00:00 的 UTC epoch 秒數（month 可為 13，代表下一年 1 月）。
+    """
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return int(TAIPEI_TZ.localize(datetime(year, month, 1)).timestamp())
+
+
+class ReadingArchive:
+    """
+    已結束月份的感測數據以每株植物、每月一個 Parquet 檔封存：<root>/<mac>/<YYYY-MM>.parquet。
+    欄位為 int64 的 ts 與 float64 數值欄位，過去的月份不需要再解析字串。
+    查詢時只開啟範圍內的月份檔，只讀取需要的欄位，並以 memory map 讀檔。
+    """
+    def __init__(self, root):
+        self.root = root
+
+    @property
+    def enabled(self):
+        return pa is not None
+
+    def month_path(self, mac_address, year, month):
+        return os.path.join(self.root, mac_address, f"{year:04d}-{month:02d}.parquet")
+
+    def months_between(self, start_ts, end_ts):
+        start = datetime.fromtimestamp(start_ts, TAIPEI_TZ)
+        end = datetime.fromtimestamp(end_ts, TAIPEI_TZ)
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            yield year, month
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    def read(self, mac_address, start_ts, end_ts, columns):
+        columns = ["ts", *columns]
+        frames = []
+        if self.enabled and start_ts <= end_ts:
+            import pyarrow.parquet as pq
+            for year, month in self.months_between(start_ts, end_ts):
+                path = self.month_path(mac_address, year, month)
+                if os.path.exists(path):
+                    table = pq.read_table(path, columns=columns, memory_map=True,
+                                          filters=[("ts", ">=", start_ts), ("ts", "<=", end_ts)])
+                    frames.append(table.to_pandas())
+        if not frames:
+            return pd.DataFrame({col: pd.Series(dtype='int64' if col == "ts" else 'float64') for col in columns})
+        return pd.concat(frames, ignore_index=True)
+
+    def write_month(self, mac_address, year, month, readings):
+        """
+        寫入（或合併到既有的）月份檔；先寫暫存檔再替換，避免產生不完整的檔案。
+        """
+        import pyarrow.parquet as pq
+        path = self.month_path(mac_address, year, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        columns = ["ts", *SENSOR_COLUMNS.values()]
+        frame = readings[columns]
+        if os.path.exists(path):
+            frame = pd.concat([pq.read_table(path).to_pandas(), frame], ignore_index=True)
+        frame = frame.drop_duplicates(subset="ts", keep="last").sort_values("ts")
+        schema = pa.schema([("ts", pa.int64()), *[(col, pa.float64()) for col in SENSOR_COLUMNS.values()]])
+        table = pa.Table.from_pandas(frame.astype({"ts": "int64", **{col: "float64" for col in SENSOR_COLUMNS.values()}}),
+                                     schema=schema, preserve_index=False)
+        tmp_path = path + ".tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    def remove(self, mac_address):
+        shutil.rmtree(os.path.join(self.root, mac_address), ignore_errors=True)
+
+    def months(self, mac_address):
+        """
+        回傳已封存的 (年, 月)，依時間排序。
+        """
+        directory = os.path.join(self.root, mac_address)
+        if not os.path.isdir(directory):
+            return []
+        names = sorted(name[:-len(".parquet")] for name in os.listdir(directory) if name.endswith(".parquet"))
+        return [tuple(int(part) for part in name.split("-")) for name in names]
+
+    def mac_addresses(self):
+        return sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []
+
+    def expire(self, before_ts):
+        """
+        刪除整個月份都早於 before_ts 的封存檔，回傳刪除的檔案數。
+        """
+        removed = 0
+        for mac_address in self.mac_addresses():
+            for year, month in self.months(mac_address):
+                if month_start_ts(year, month + 1) <= before_ts:
+                    os.remove(self.month_path(mac_address, year, month))
+                    removed += 1
+        return removed
+
+
+# -----------------------------
+# Google Sheets 鏡像
+# -----------------------------
+class SheetsMirror:
+    """
+    背景執行緒：把透過 /api/ingest 寫入、尚未鏡像的數據批次附加到各植物的工作表。
+    每次 Sheets API 呼叫之間至少間隔 min_interval 秒，遇到錯誤時以指數退避延後下一輪。
+    是否已鏡像記錄在 sensor_readings.pending_mirror，重新啟動後會從中斷處繼續。
+    多個程序時只有持有 sheets-mirror 租約的程序會鏡像；持有者停止後，租約在 lease_ttl 秒內由其他程序接手。
+    """
+    def __init__(self, model, interval=10, min_interval=1.1, batch_size=500, max_backoff=300, lease_ttl=600):
+        self.model = model
+        self.lease_ttl = lease_ttl
+        self.interval = interval
+        self.min_interval = min_interval
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self._worksheets = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="sheets-mirror", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.model.shared.release_lease("sheets-mirror")
+
+    def run(self):
+        backoff = self.interval
+        while not self._stop.wait(backoff):
+            try:
+                if not self.model.shared.acquire_lease("sheets-mirror", self.lease_ttl):
+                    continue
+                run_blocking(self.flush)
+                backoff = self.interval
+            except Exception as e:
+                backoff = min(backoff * 2, self.max_backoff)
+                logging.error(f"鏡像數據到 Google Sheets 失敗，{backoff} 秒後重試: {e}")
+
+    def flush(self):
+        """
+        每台裝置以一次 append_rows 附加最多 batch_size 筆待鏡像數據，回傳附加的總筆數。
+        """
+        with self.model.engine.connect() as conn:
+            macs = [r.mac_address for r in conn.execute(text("SELECT DISTINCT mac_address FROM sensor_readings WHERE pending_mirror = 1"))]
+
+        total = 0
+        failures = 0
+        for mac_address in macs:
+            with self.model.engine.connect() as conn:
+                rows = conn.execute(text(f"""
+                    SELECT ts, {", ".join(SENSOR_COLUMNS.values())} FROM sensor_readings
+                    WHERE mac_address=:mac_address AND pending_mirror = 1 ORDER BY ts LIMIT :limit
+                """), {"mac_address": mac_address, "limit": self.batch_size}).all()
+            if not rows:
+                continue
+
+            values = [[datetime.fromtimestamp(r.ts, tz=TAIPEI_TZ).strftime(SHEET_TIME_FORMAT),
+                       *["" if v is None else v for v in r[1:]]] for r in rows]
+            try:
+                self.model.google_call("append_rows", self.get_worksheet(mac_address).append_rows, values, value_input_option='RAW')
+            except gspread.exceptions.WorksheetNotFound as e:
+                # 建立工作表的背景工作已放棄或從未送出時重新送出，下一輪再鏡像
+                logging.warning(f"工作表 '{mac_address}' 不存在: {e}")
+                self.model.resubmit_create_worksheet(mac_address)
+                failures += 1
+                continue
+            except Exception as e:
+                # 工作表可能仍由背景工作建立中；其他裝置照常鏡像，下一輪再重試
+                logging.warning(f"鏡像數據到工作表 '{mac_address}' 失敗: {e}")
+                self.forget(mac_address)
+                failures += 1
+                continue
+
+            with self.model.engine.begin() as conn:
+                conn.execute(text("""
+                    UPDATE sensor_readings SET pending_mirror = 0
+                    WHERE mac_address=:mac_address AND pending_mirror = 1 AND ts BETWEEN :first_ts AND :last_ts
+                """), {"mac_address": mac_address, "first_ts": rows[0].ts, "last_ts": rows[-1].ts})
+            total += len(rows)
+            logging.info(f"已鏡像 {len(rows)} 筆數據到工作表 '{mac_address}'。")
+            time.sleep(self.min_interval)
+        if failures and failures == len(macs):
+            raise RuntimeError(f"{failures} 個工作表鏡像失敗")
+        return total
+
+    def forget(self, mac_address):
+        self._worksheets.pop(mac_address, None)
+
+    def get_worksheet(self, mac_address):
+        worksheet = self._worksheets.get(mac_address)
+        if worksheet is None:
+            plant = self.model.get_plant_by_mac(mac_address)
+            sheet_id = plant.sheet_id if plant and plant.sheet_id else self.model.fixed_sheet_id
+            worksheet = self.model.google_call("worksheet", self.model.get_spreadsheet(sheet_id).worksheet, mac_address)
+            self._worksheets[mac_address] = worksheet
+        return worksheet
 
 
 # -----------------------------
 # Model 層
 # -----------------------------
 class PlantModel:
-    def __init__(self, app, db_url='sqlite:///plant_data.db', gs_keyfile='smart-planting-468806-f5b899621000.json', fixed_sheet_id='1NoqaDFRS137ov8gOsbmlixzWhhwGj5EdfANvjotlv28'):
+    def __init__(self, app, db_url='sqlite:///plant_data.db', gs_keyfile='smart-planting-468806-f5b899621000.json', fixed_sheet_id='1NoqaDFRS137ov8gOsbmlixzWhhwGj5EdfANvjotlv28',
+                 cache_ttl=30, cache_max_entries=256, cache_max_rows=500000, db_pool_size=10, db_max_overflow=20, archive_dir=None,
+                 client=None, metrics=True, shared_state=None, google_timeout=30, auth_retry_interval=60,
+                 stats_window=60, stats_span=3600, water_rule_cooldown=1800, water_rule_max_age=900,
+                 raw_retention_days=None, hourly_retention_days=None):
         logging.basicConfig(level=logging.DEBUG)
         self.app = app
-        self.engine = create_engine(db_url)
+        # 效能指標，由 /metrics 輸出；metrics=False 時不記錄
+        self.metrics = Metrics(enabled=metrics)
+        self.describe_metrics()
+        self.engine = self.create_db_engine(db_url, db_pool_size, db_max_overflow)
         self.fixed_sheet_id = fixed_sheet_id.strip()
+
+        # 多個 worker 程序之間同步記憶體中的索引與快取、喚醒長輪詢，預設經由同一個 SQLite 資料庫
+        self.shared = shared_state or SQLiteSharedState(self.engine)
         
         # 修正：將 UPLOAD_FOLDER 設定為屬性
         self.upload_folder = os.path.join(self.app.root_path, 'static', 'uploads')
         os.makedirs(self.upload_folder, exist_ok=True)
 
-        # Google Sheets 設定
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = service_account.Credentials.from_service_account_file(gs_keyfile, scopes=scope)
-        self.client = gspread.authorize(creds)
+        # Google Sheets 設定；可傳入 client（例如 fake_gspread.FakeClient）以離線執行
+        # 未傳入時在第一次呼叫 Google API 時才讀取金鑰並授權，金鑰或網路有問題時伺服器仍可啟動
+        self.gs_keyfile = gs_keyfile
+        self.google_timeout = google_timeout
+        self.auth_retry_interval = auth_retry_interval
+        self._client = client
+        self._client_lock = threading.Lock()
+        self._auth_error = None  # (失敗時間, 例外)，auth_retry_interval 秒內不再重試
+        # 最近一次 Google API 呼叫的結果，由 /readyz 回報
+        self.google_status = {"ok": None, "operation": None, "error": None, "at": None}
+
+        # 快取：重複使用已開啟的 Spreadsheet，以及 get_plant_data 的查詢結果（以資料筆數計算用量）
+        self.spreadsheet_cache = TTLCache(ttl=600, max_entries=16)
+        self.data_cache = TTLCache(ttl=cache_ttl, max_entries=cache_max_entries, max_cost=cache_max_rows)
+        # 最近已從工作表尾端查過、仍沒有數據的裝置，避免首頁每次輪詢都呼叫 Google API
+        self.sheet_tail_cache = TTLCache(ttl=60, max_entries=1024)
+        # 已送出初次同步工作的裝置，避免每次查詢都讀取 jobs 資料表
+        self.initial_sync_requested = set()
+
+        # 已結束月份的 Parquet 封存（需安裝 pyarrow）
+        self.archive = ReadingArchive(archive_dir or os.path.join(self.app.root_path, 'archive'))
+        # 保留原始數據與每小時彙總的天數（None 表示永久保留），由 expire_raw_readings() 執行；每日彙總永久保留
+        # 每小時彙總至少保留到原始數據的期限，讓查詢不會有兩者都已刪除的空檔
+        self.raw_retention_days = raw_retention_days
+        self.hourly_retention_days = None
+        if raw_retention_days is not None and hourly_retention_days is not None:
+            self.hourly_retention_days = max(hourly_retention_days, raw_retention_days)
+
+        # 把 /api/ingest 收到的數據批次鏡像到 Google Sheets，由啟動程式呼叫 sheets_mirror.start()
+        self.sheets_mirror = SheetsMirror(self)
+
+        # 建立/刪除工作表改由背景工作執行，啟動程式呼叫 jobs.resume() 繼續未完成的工作
+        self.jobs = JobExecutor(self.engine, shared_state=self.shared)
+        self.jobs.register('create_worksheet', self.run_create_worksheet_job)
+        self.jobs.register('delete_worksheet', self.run_delete_worksheet_job)
+        self.jobs.register('photo_variants', self.run_photo_variants_job)
+        self.jobs.register('sync_worksheet', self.run_sync_worksheet_job)
 
         # 初始化資料表
         self.init_db()
 
+        # plants 的記憶體索引
+        self.registry = PlantRegistry()
+        self.reload_registry()
+
+        # 每台裝置最新一筆數據的索引（記憶體 + latest_readings 資料表）
+        self.latest_lock = threading.Lock()
+        self.latest_readings = self.load_latest_readings()
+
+        # 每台裝置最近 stats_window 筆（最多 stats_span 秒）數據的滾動統計，第一次使用時從資料庫載入
+        self.rolling_stats = RollingStats(size=stats_window, span=stats_span)
+        # 伺服器端自動澆水規則（由 /api/update_water_settings 設定），每次寫入數據時評估
+        self.water_rule_cooldown = water_rule_cooldown
+        self.water_rule_max_age = water_rule_max_age
+        self.water_rules = self.load_water_rules()
+
+        self.background_started = False
+
+        # 其他程序變更植物資料或寫入數據時，重新載入對應的索引並讓快取失效
+        self.shared.subscribe('plants', self.on_plant_changed)
+        self.shared.subscribe('readings', self.on_readings_changed)
+        self.shared.subscribe('water_rules', self.on_water_rule_changed)
+
+    def start_background(self):
+        """
+        啟動背景執行緒：接收其他程序的事件、鏡像數據到 Google Sheets、繼續未完成的背景工作。
+        每個服務請求的程序各呼叫一次（create_app 預設會呼叫）。
+        """
+        self.shared.start()
+        self.sheets_mirror.start()
+        self.jobs.resume()
+        self.background_started = True
+
+    def on_plant_changed(self, plant_id):
+        with self.engine.connect() as conn:
+            if self.reload_plant(conn, int(plant_id)) is None:
+                self.registry.remove(int(plant_id))
+
+    def on_readings_changed(self, mac_address):
+        self.invalidate_plant_cache(mac_address)
+        # 本程序沒看到的數據由下次更新時重新從資料庫載入
+        self.rolling_stats.forget(mac_address)
+        with self.engine.connect() as conn:
+            row = conn.execute(text("SELECT * FROM latest_readings WHERE mac_address=:mac_address"),
+                               {"mac_address": mac_address}).mappings().first()
+        with self.latest_lock:
+            if row is None:
+                self.latest_readings.pop(mac_address, None)
+            else:
+                self.latest_readings[mac_address] = self.reading_to_record(row)
+
+    def on_water_rule_changed(self, mac_address):
+        with self.engine.connect() as conn:
+            row = conn.execute(text("SELECT * FROM water_rules WHERE mac_address=:mac_address"),
+                               {"mac_address": mac_address}).mappings().first()
+        if row is None:
+            self.water_rules.pop(mac_address, None)
+        else:
+            self.water_rules[mac_address] = dict(row)
+
+    def create_db_engine(self, db_url, pool_size, max_overflow):
+        """
+        建立連線池並調整 SQLite 以利並行存取：WAL 讓讀取不會被寫入阻擋，
+        busy_timeout 讓同時寫入時等待而不是立即失敗。
+        """
+        if db_url.startswith('sqlite') and ':memory:' not in db_url and db_url != 'sqlite://':
+            engine = create_engine(db_url, pool_size=pool_size, max_overflow=max_overflow)
+        else:
+            engine = create_engine(db_url)
+
+        if engine.dialect.name == 'sqlite':
+            @event.listens_for(engine, "connect")
+            def set_sqlite_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=NORMAL")
+                cursor.execute("PRAGMA busy_timeout=5000")
+                cursor.close()
+
+        if self.metrics.enabled:
+            @event.listens_for(engine, "before_cursor_execute")
+            def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+                context._query_started = time.perf_counter()
+
+            @event.listens_for(engine, "after_cursor_execute")
+            def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+                elapsed = time.perf_counter() - context._query_started
+                self.metrics.observe("db_query_duration_seconds", elapsed)
+                self.metrics.add_phase("db", elapsed)
+        return engine
+
+    def describe_metrics(self):
+        m = self.metrics
+        m.describe("db_query_duration_seconds", "histogram", "SQLite 查詢耗時")
+        m.describe("google_api_requests_total", "counter", "Google API 呼叫次數（依操作與結果）")
+        m.describe("google_api_request_duration_seconds", "histogram", "Google API 呼叫耗時（依操作）")
+        m.describe("sheet_rows_parsed_total", "counter", "從工作表解析的資料列數")
+        m.describe("sheet_parse_duration_seconds", "histogram", "解析工作表資料列的耗時")
+        m.describe("plant_data_query_duration_seconds", "histogram", "get_plant_data 未命中快取時的查詢耗時")
+        m.describe("water_rule_triggers_total", "counter", "伺服器端自動澆水規則觸發的次數")
+        m.describe("export_rows_total", "counter", "/api/export 匯出的資料列數")
+        m.describe("plant_data_rows", "histogram", "每次 get_plant_data 回傳的資料筆數", buckets=ROW_BUCKETS)
+        m.gauge("command_queue_depth", "各裝置待執行的指令數", self.command_queue_depths)
+        m.gauge("sheets_mirror_pending_rows", "等待鏡像到 Google Sheets 的數據筆數",
+                lambda: [({}, self.pending_mirror_count())])
+        m.gauge("cache_requests_total", "快取查詢次數（依快取與結果）", self.cache_request_counts, kind="counter")
+
+    def command_queue_depths(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("SELECT mac_address, COUNT(*) AS depth FROM device_commands GROUP BY mac_address")).all()
+        return [({"mac_address": r.mac_address}, r.depth) for r in rows]
+
+    def pending_mirror_count(self):
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT COUNT(*) FROM sensor_readings WHERE pending_mirror = 1")).scalar()
+
+    def cache_request_counts(self):
+        counts = []
+        for cache, stats in self.cache_stats().items():
+            counts.append(({"cache": cache, "result": "hit"}, stats["hits"]))
+            counts.append(({"cache": cache, "result": "miss"}, stats["misses"]))
+        return counts
+
+    @property
+    def client(self):
+        """
+        gspread 用戶端，第一次使用時才讀取金鑰並授權；授權失敗後 auth_retry_interval 秒內直接拋出同一個錯誤。
+        """
+        if self._client is not None:
+            return self._client
+        with self._client_lock:
+            if self._client is None:
+                if self._auth_error is not None and time.monotonic() - self._auth_error[0] < self.auth_retry_interval:
+                    raise self._auth_error[1]
+                try:
+                    self._client = self.google_call("authorize", self.authorize)
+                    self._auth_error = None
+                except Exception as e:
+                    self._auth_error = (time.monotonic(), e)
+                    logging.error(f"Google Sheets 授權失敗，{self.auth_retry_interval} 秒後才會重試: {e}")
+                    raise
+            return self._client
+
+    def authorize(self):
+        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+        creds = service_account.Credentials.from_service_account_file(self.gs_keyfile, scopes=scope)
+        client = gspread.authorize(creds)
+        # 網路無法連線時讓呼叫逾時失敗，而不是無限期佔住背景執行緒或請求
+        client.set_timeout(self.google_timeout)
+        return client
+
+    def google_call(self, operation, fn, *args, **kwargs):
+        """
+        呼叫 Google API 並記錄次數、耗時與最近一次的結果。
+        """
+        outcome = "error"
+        error = None
+        try:
+            with self.metrics.timer("google_api_request_duration_seconds", phase="sheets", operation=operation):
+                result = fn(*args, **kwargs)
+            outcome = "ok"
+            return result
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self.metrics.inc("google_api_requests_total", operation=operation, outcome=outcome)
+            self.google_status = {"ok": outcome == "ok", "operation": operation, "error": error, "at": time.time()}
+
+    def check_ready(self):
+        """
+        回傳 (是否可服務, 各項狀態)。只有資料庫是必要的；Google Sheets 無法連線時照常服務，只回報狀態。
+        """
+        checks = {}
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            checks["database"] = {"ok": True}
+        except Exception as e:
+            checks["database"] = {"ok": False, "error": str(e)}
+        google = dict(self.google_status)
+        google["authorized"] = self._client is not None
+        if self._auth_error is not None:
+            google["error"] = str(self._auth_error[1])
+        checks["google_sheets"] = google
+        checks["background"] = {"started": self.background_started}
+        return checks["database"]["ok"], checks
+
     def init_db(self):
         logging.info("初始化資料庫...")
         with self.engine.connect() as conn:
@@ -49,168 +1499,1356 @@ class PlantModel:
                     reset_flag INTEGER DEFAULT 0
                 );
             """))
+            # 感測數據的本地時間序列表：以 (mac_address, ts) 為主鍵，區間查詢直接走索引
+            # ts 為 UTC epoch 秒數
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS sensor_readings (
+                    mac_address TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    temperature REAL,
+                    humidity REAL,
+                    soil_moisture REAL,
+                    light REAL,
+                    pending_mirror INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (mac_address, ts)
+                ) WITHOUT ROWID;
+            """))
+            # 升級既有資料庫：pending_mirror 標記透過 /api/ingest 寫入、尚未鏡像到 Google Sheets 的數據
+            columns = [r.name for r in conn.execute(text("PRAGMA table_info(sensor_readings)"))]
+            if "pending_mirror" not in columns:
+                conn.execute(text("ALTER TABLE sensor_readings ADD COLUMN pending_mirror INTEGER NOT NULL DEFAULT 0"))
+            conn.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_sensor_readings_pending_mirror
+                ON sensor_readings (mac_address, ts) WHERE pending_mirror = 1;
+            """))
+            # 每個工作表的同步水位：last_row 為已同步的最後一列列號（第 1 列為標題）
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    mac_address TEXT PRIMARY KEY,
+                    last_row INTEGER NOT NULL DEFAULT 1,
+                    last_ts INTEGER,
+                    synced_at INTEGER
+                );
+            """))
+            # 每台裝置最新一筆數據，讓「最新數據」查詢與歷史長度無關
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS latest_readings (
+                    mac_address TEXT PRIMARY KEY,
+                    ts INTEGER NOT NULL,
+                    temperature REAL,
+                    humidity REAL,
+                    soil_moisture REAL,
+                    light REAL
+                );
+            """))
+            # 升級既有資料庫時，從 sensor_readings 一次性建立索引
+            if conn.execute(text("SELECT 1 FROM latest_readings LIMIT 1")).first() is None:
+                conn.execute(text("""
+                    INSERT INTO latest_readings (mac_address, ts, temperature, humidity, soil_moisture, light)
+                    SELECT s.mac_address, s.ts, s.temperature, s.humidity, s.soil_moisture, s.light
+                    FROM sensor_readings s
+                    JOIN (SELECT mac_address, MAX(ts) AS ts FROM sensor_readings GROUP BY mac_address) m
+                      ON s.mac_address = m.mac_address AND s.ts = m.ts
+                """))
+            # 每台裝置的待送指令佇列，seq 遞增，裝置回報執行到哪個 seq 後才移除
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS device_commands (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    mac_address TEXT NOT NULL,
+                    case_no INTEGER NOT NULL,
+                    value INTEGER NOT NULL,
+                    created_at INTEGER NOT NULL
+                );
+            """))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_device_commands_mac ON device_commands (mac_address, seq);"))
+            # 每台裝置已封存到 Parquet 的範圍：archived_until 之前的數據只從封存檔讀取
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS archive_state (
+                    mac_address TEXT PRIMARY KEY,
+                    archived_until INTEGER NOT NULL
+                );
+            """))
+            # 伺服器端自動澆水規則：last_triggered_at 用於冷卻時間，多個程序共用
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS water_rules (
+                    mac_address TEXT PRIMARY KEY,
+                    enabled INTEGER NOT NULL,
+                    threshold REAL NOT NULL,
+                    cooldown INTEGER NOT NULL,
+                    last_triggered_at INTEGER,
+                    updated_at INTEGER NOT NULL
+                );
+            """))
+            # 每小時/每日彙總表；新寫入的數據由觸發器累加（INSERT OR IGNORE 略過的重複數據不會觸發）
+            existing = {r.name for r in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+            metric_values = " UNION ALL ".join(f"SELECT '{col}' AS metric, NEW.{col} AS value" for col in SENSOR_COLUMNS.values())
+            for table, size in ROLLUP_TABLES.values():
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        mac_address TEXT NOT NULL,
+                        metric TEXT NOT NULL,
+                        bucket_ts INTEGER NOT NULL,
+                        sum REAL NOT NULL,
+                        min REAL NOT NULL,
+                        max REAL NOT NULL,
+                        count INTEGER NOT NULL,
+                        PRIMARY KEY (mac_address, metric, bucket_ts)
+                    ) WITHOUT ROWID;
+                """))
+                conn.execute(text(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}_on_insert AFTER INSERT ON sensor_readings
+                    BEGIN
+                        INSERT INTO {table} (mac_address, metric, bucket_ts, sum, min, max, count)
+                        SELECT NEW.mac_address, metric, NEW.ts - (NEW.ts + {TAIPEI_OFFSET}) % {size}, value, value, value, 1
+                        FROM ({metric_values}) WHERE value IS NOT NULL
+                        ON CONFLICT(mac_address, metric, bucket_ts) DO UPDATE SET
+                            sum = {table}.sum + excluded.sum, min = MIN({table}.min, excluded.min),
+                            max = MAX({table}.max, excluded.max), count = {table}.count + excluded.count;
+                    END;
+                """))
             conn.commit()
-            logging.info("資料表 'plants' 檢查/創建成功。")
+            logging.info("資料表 'plants'、'sensor_readings'、'sync_state'、'latest_readings'、'device_commands' 檢查/創建成功。")
+        # 升級既有資料庫時，從現有的原始數據與封存一次性建立彙總表
+        if any(table not in existing for table, _ in ROLLUP_TABLES.values()):
+            self.rebuild_rollups()
     
 
-    def add_plant(self, name, photo_path, mac_address):
+    def add_plant(self, name, photo_path, mac_address):
+        with self.engine.connect() as conn:
+            result = conn.execute(text("INSERT INTO plants (name, photo_path, sheet_id, mac_address) VALUES (:name, :photo_path, :sheet_id, :mac_address)"),
+                                  {"name": name, "photo_path": photo_path, "sheet_id": self.fixed_sheet_id, "mac_address": mac_address})
+            self.shared.publish('plants', result.lastrowid, conn)
+            conn.commit()
+            self.reload_plant(conn, result.lastrowid)
+
+    def reload_registry(self):
+        """
+        從資料庫重新載入所有植物資料；未接收其他程序事件的程序（例如 update.py）在每次處理前呼叫。
+        """
+        with self.engine.connect() as conn:
+            self.registry.load(conn.execute(text("SELECT * FROM plants")).all())
+
+    def reload_plant(self, conn, plant_id):
+        """
+        從資料庫重新讀取一筆植物資料並更新記憶體索引。
+        """
+        row = conn.execute(text("SELECT * FROM plants WHERE id=:id"), {"id": plant_id}).first()
+        if row is not None:
+            self.registry.put(row)
+        return row
+    
+    def delete_plant(self, plant_id):
+        """
+        刪除指定 plant_id 的所有數據，包括 Google Sheets 和資料庫紀錄。
+        """
+        conn = None
+        try:
+            # 1. 取得植物的完整資訊
+            plant = self.get_plant_by_id(plant_id)
+            if not plant:
+                return False, "找不到植物"
+
+            # 2. 沒有其他植物使用同一張照片時刪除照片檔案
+            self.remove_photo(plant.photo_path, plant_id)
+
+            # 3. 刪除資料庫中的紀錄
+            with self.engine.connect() as conn:
+                # 刪除 plants 表中的植物紀錄
+                result = conn.execute(text("DELETE FROM plants WHERE id=:id"), {"id": plant_id})
+                # 刪除本地儲存的感測數據
+                conn.execute(text("DELETE FROM sensor_readings WHERE mac_address=:mac_address"), {"mac_address": plant.mac_address})
+                conn.execute(text("DELETE FROM sync_state WHERE mac_address=:mac_address"), {"mac_address": plant.mac_address})
+                conn.execute(text("DELETE FROM latest_readings WHERE mac_address=:mac_address"), {"mac_address": plant.mac_address})
+                conn.execute(text("DELETE FROM device_commands WHERE mac_address=:mac_address"), {"mac_address": plant.mac_address})
+                conn.execute(text("DELETE FROM archive_state WHERE mac_address=:mac_address"), {"mac_address": plant.mac_address})
+                conn.execute(text("DELETE FROM water_rules WHERE mac_address=:mac_address"), {"mac_address": plant.mac_address})
+                for table, _ in ROLLUP_TABLES.values():
+                    conn.execute(text(f"DELETE FROM {table} WHERE mac_address=:mac_address"), {"mac_address": plant.mac_address})
+                self.shared.publish('plants', plant.id, conn)
+                self.shared.publish('readings', plant.mac_address, conn)
+                self.shared.publish('water_rules', plant.mac_address, conn)
+                conn.commit()
+                logging.info(f"已成功刪除植物 ID {plant_id} 的資料庫紀錄。")
+            self.registry.remove(plant.id)
+            self.archive.remove(plant.mac_address)
+            self.invalidate_plant_cache(plant.mac_address)
+            self.sheets_mirror.forget(plant.mac_address)
+            self.rolling_stats.forget(plant.mac_address)
+            self.water_rules.pop(plant.mac_address, None)
+            with self.latest_lock:
+                self.latest_readings.pop(plant.mac_address, None)
+
+            # 4. 由背景工作刪除 Google Sheets 工作表
+            self.jobs.submit('delete_worksheet', {"sheet_id": plant.sheet_id or self.fixed_sheet_id, "mac_address": plant.mac_address},
+                             key=plant.mac_address)
+
+            return True, plant
+        
+        except Exception as e:
+            logging.error(f"刪除植物時發生錯誤: {e}")
+            return False, str(e)
+    def get_plant_by_mac(self, mac_address):
+        return self.registry.by_mac(mac_address)
+
+    def get_all_plants(self):
+        return [{"id": r.id, "name": r.name, "photo_path": r.photo_path, "sheet_id": r.sheet_id, "mac_address": r.mac_address}
+                for r in self.registry.all()]
+
+    def get_plant_by_id(self, plant_id):
+        return self.registry.by_id(plant_id)
+
+    def set_reset_flag(self, mac_address, value):
+        """
+        設定裝置的 reset_flag，回傳是否找到該裝置。
+        """
+        with self.engine.connect() as conn:
+            result = conn.execute(text("UPDATE plants SET reset_flag = :value WHERE mac_address = :mac_address"),
+                                  {"value": value, "mac_address": mac_address})
+            plant = self.registry.by_mac(mac_address)
+            if result.rowcount:
+                if plant is not None:
+                    self.shared.publish('plants', plant.id, conn)
+                self.shared.publish('device', mac_address, conn)
+            conn.commit()
+            if plant is not None:
+                self.reload_plant(conn, plant.id)
+        return result.rowcount > 0
+
+    def pop_reset_flag(self, mac_address):
+        """
+        讀取並清除裝置的 reset_flag；找不到裝置時回傳 None。
+        只有在旗標已設定時才寫入資料庫，且同一次重設只會回報給一個請求。
+        """
+        plant = self.registry.by_mac(mac_address)
+        if plant is None:
+            return None
+        if plant.reset_flag != 1:
+            return False
+        with self.engine.connect() as conn:
+            result = conn.execute(text("UPDATE plants SET reset_flag = 0 WHERE mac_address = :mac_address AND reset_flag = 1"),
+                                  {"mac_address": mac_address})
+            if result.rowcount:
+                self.shared.publish('plants', plant.id, conn)
+            conn.commit()
+            self.reload_plant(conn, plant.id)
+        return result.rowcount > 0
+
+    def update_plant(self, plant_id, name, photo_file):
+        plant = self.get_plant_by_id(plant_id)
+        if not plant:
+            raise ValueError("找不到植物")
+
+        photo_path = plant.photo_path
+        if photo_file and photo_file.filename:
+            photo_path = self.save_photo(photo_file)
+            # 舊照片沒有其他植物使用時刪除
+            if plant.photo_path != photo_path:
+                self.remove_photo(plant.photo_path, plant.id)
+
+        # 更新資料庫
+        with self.engine.connect() as conn:
+            conn.execute(text("UPDATE plants SET name = :name, photo_path = :photo_path WHERE id = :id"),
+                         {"name": name, "photo_path": photo_path, "id": plant.id})
+            self.shared.publish('plants', plant.id, conn)
+            conn.commit()
+            self.reload_plant(conn, plant.id)
+            logging.info(f"植物 ID {plant_id} 的資料已更新。")
+
+    def save_photo(self, photo_file):
+        """
+        將上傳的照片以串流方式寫入暫存檔並同時計算 SHA-256，以雜湊值命名；
+        相同內容的照片只保存一份。縮圖由背景工作產生，回傳照片網址。
+        安裝 Pillow 時先檢查檔案是否為可辨識的圖片，不是時拋出 ValueError。
+        """
+        ext = secure_filename(photo_file.filename).rsplit('.', 1)[-1].lower()
+        if ext not in PHOTO_EXTENSIONS:
+            raise ValueError(f"不支援的照片格式: {ext}")
+
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.upload_folder, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = photo_file.stream.read(64 * 1024)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+            if Image is not None:
+                try:
+                    with Image.open(tmp_path) as image:
+                        image.verify()
+                except Exception:
+                    raise ValueError("無法辨識的照片檔案")
+            filename = f"{digest.hexdigest()}.{'jpg' if ext == 'jpeg' else ext}"
+            file_path = os.path.join(self.upload_folder, filename)
+            if os.path.exists(file_path):
+                os.remove(tmp_path)
+                logging.info(f"照片已存在，沿用: {filename}")
+            else:
+                os.replace(tmp_path, file_path)
+                logging.info(f"已儲存照片: {filename}")
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.jobs.submit('photo_variants', {"filename": filename}, key=filename)
+        return PHOTO_URL_PREFIX + filename
+
+    def photo_file_paths(self, photo_path):
+        """
+        回傳照片原圖與所有縮圖在磁碟上的路徑；不是本機上傳的照片回傳空列表。
+        """
+        if not photo_path:
+            return []
+        if photo_path.startswith('/static/uploads/'):  # 舊版以原檔名儲存的照片
+            return [os.path.join(self.upload_folder, os.path.basename(photo_path))]
+        if not photo_path.startswith(PHOTO_URL_PREFIX):
+            return []
+        filename = os.path.basename(photo_path)
+        stem = filename.rsplit('.', 1)[0]
+        return [os.path.join(self.upload_folder, filename),
+                *[os.path.join(self.upload_folder, f"{stem}.{variant}.jpg") for variant in PHOTO_VARIANTS]]
+
+    def remove_photo(self, photo_path, plant_id):
+        """
+        沒有其他植物使用同一張照片時，刪除原圖與縮圖。
+        """
+        if any(p.photo_path == photo_path and p.id != plant_id for p in self.registry.all()):
+            return
+        for file_path in self.photo_file_paths(photo_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+                logging.info(f"已刪除照片檔案: {file_path}")
+
+    def run_photo_variants_job(self, payload):
+        filename = payload["filename"]
+        source = os.path.join(self.upload_folder, filename)
+        if Image is None:
+            logging.info("未安裝 Pillow，略過產生縮圖。")
+            return
+        if not os.path.exists(source):
+            logging.info(f"照片 '{filename}' 已被刪除，略過產生縮圖。")
+            return
+        stem = filename.rsplit('.', 1)[0]
+        try:
+            original = Image.open(source)
+        except (Image.UnidentifiedImageError, Image.DecompressionBombError) as e:
+            # 檔案內容本身無法解碼，重試也不會成功
+            logging.error(f"無法辨識照片 '{filename}'，略過產生縮圖: {e}")
+            return
+        with original:
+            # 依 EXIF 轉正後再縮小，透明背景轉為白色
+            image = ImageOps.exif_transpose(original)
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            else:
+                image = image.convert("RGB")
+            for variant, size in PHOTO_VARIANTS.items():
+                resized = image.copy()
+                resized.thumbnail((size, size), Image.LANCZOS)
+                target = os.path.join(self.upload_folder, f"{stem}.{variant}.jpg")
+                tmp_path = target + ".tmp"
+                resized.save(tmp_path, "JPEG", quality=82, optimize=True, progressive=True)
+                os.replace(tmp_path, target)
+        logging.info(f"已產生照片 '{filename}' 的縮圖。")
+
+    def enqueue_commands(self, mac_address, commands, conn=None):
+        """
+        在同一個交易中將多個指令 ({"case", "value"}) 加入裝置的佇列，回傳含 seq 的指令。
+        尚未送達的同類設定指令會被新值取代。傳入 conn 時沿用呼叫端的交易。
+        """
+        if conn is None:
+            with self.engine.begin() as conn:
+                return self.enqueue_commands(mac_address, commands, conn=conn)
+        queued = []
+        for command in commands:
+            if command["case"] in SETTING_CASES:
+                conn.execute(text("DELETE FROM device_commands WHERE mac_address=:mac_address AND case_no=:case_no"),
+                             {"mac_address": mac_address, "case_no": command["case"]})
+            result = conn.execute(text("""
+                INSERT INTO device_commands (mac_address, case_no, value, created_at)
+                VALUES (:mac_address, :case_no, :value, :created_at)
+            """), {"mac_address": mac_address, "case_no": command["case"], "value": command["value"], "created_at": int(time.time())})
+            queued.append({"seq": result.lastrowid, "case": command["case"], "value": command["value"]})
+        self.shared.publish('device', mac_address, conn)
+        return queued
+
+    def get_pending_commands(self, mac_address):
         with self.engine.connect() as conn:
-            conn.execute(text("INSERT INTO plants (name, photo_path, sheet_id, mac_address) VALUES (:name, :photo_path, :sheet_id, :mac_address)"),
-                         {"name": name, "photo_path": photo_path, "sheet_id": self.fixed_sheet_id, "mac_address": mac_address})
-            conn.commit()
-    
-    def delete_plant(self, plant_id):
+            result = conn.execute(text("SELECT seq, case_no, value FROM device_commands WHERE mac_address=:mac_address ORDER BY seq"),
+                                  {"mac_address": mac_address})
+            return [{"seq": r.seq, "case": r.case_no, "value": r.value} for r in result]
+
+    def ack_commands(self, mac_address, up_to_seq):
         """
-        刪除指定 plant_id 的所有數據，包括 Google Sheets 和資料庫紀錄。
+        移除 seq 小於等於 up_to_seq 的指令，回傳移除的數量。
         """
-        conn = None
-        try:
-            # 1. 取得植物的完整資訊
-            plant = self.get_plant_by_id(plant_id)
-            if not plant:
-                return False, "找不到植物"
+        with self.engine.begin() as conn:
+            result = conn.execute(text("DELETE FROM device_commands WHERE mac_address=:mac_address AND seq <= :seq"),
+                                  {"mac_address": mac_address, "seq": up_to_seq})
+        return result.rowcount
 
-            # 2. 刪除 Google Sheets 工作表
-            try:
-                sheet = self.client.open_by_key(self.fixed_sheet_id)
-                worksheet = sheet.worksheet(plant.mac_address)
-                sheet.del_worksheet(worksheet)
-                logging.info(f"已成功刪除 Google Sheets 工作表: {plant.mac_address}")
-            except gspread.exceptions.WorksheetNotFound:
-                logging.warning(f"Google Sheets 工作表 '{plant.mac_address}' 不存在，略過刪除。")
-            except Exception as e:
-                logging.error(f"刪除 Google Sheets 工作表時發生錯誤: {e}")
-                # 這裡選擇不中斷，讓資料庫刪除繼續進行
-
-            # 3. 檢查照片檔案是否存在並刪除
-            if plant.photo_path and plant.photo_path.startswith('/static/uploads/'):
-                filename = os.path.basename(plant.photo_path)
-                file_path = os.path.join(self.upload_folder, filename)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logging.info(f"已成功刪除植物 ID {plant_id} 的照片檔案: {file_path}")
-                else:
-                    logging.warning(f"找不到植物 ID {plant_id} 的照片檔案: {file_path}")
+    def get_spreadsheet(self, sheet_id):
+        return self.spreadsheet_cache.get_or_load(sheet_id, lambda: self.google_call("open_by_key", self.client.open_by_key, sheet_id),
+                                                  cost=lambda _: 1)
 
-            # 4. 刪除資料庫中的紀錄
-            with self.engine.connect() as conn:
-                # 刪除 plants 表中的植物紀錄
-                result = conn.execute(text("DELETE FROM plants WHERE id=:id"), {"id": plant_id})
-                conn.commit()
-                logging.info(f"已成功刪除植物 ID {plant_id} 的資料庫紀錄。")
+    def invalidate_plant_cache(self, mac_address):
+        self.data_cache.invalidate(lambda key: key[0] == mac_address)
 
-            return True, plant
-        
-        except Exception as e:
-            logging.error(f"刪除植物時發生錯誤: {e}")
-            return False, str(e)
-    def get_plant_by_mac(self, mac_address):
-        with self.engine.connect() as conn:
-            return conn.execute(text("SELECT * FROM plants WHERE mac_address=:mac_address"), {"mac_address": mac_address}).first()
+    def cache_stats(self):
+        return {"spreadsheets": self.spreadsheet_cache.stats(), "plant_data": self.data_cache.stats()}
 
-    def get_all_plants(self):
-        with self.engine.connect() as conn:
-            result = conn.execute(text("SELECT id, name, photo_path, sheet_id, mac_address FROM plants ORDER BY id DESC;"))
-            return [{"id": r.id, "name": r.name, "photo_path": r.photo_path, "sheet_id": r.sheet_id, "mac_address": r.mac_address} for r in result]
+    def defer_while_unauthorized(self):
+        """
+        Google 授權失敗仍在 auth_retry_interval 冷卻中時，讓背景工作等到冷卻結束再執行，
+        避免重試次數在同一次授權失敗內全部用完。
+        """
+        error = self._auth_error
+        if self._client is None and error is not None:
+            remaining = self.auth_retry_interval - (time.monotonic() - error[0])
+            if remaining > 0:
+                raise RetryLater(f"Google Sheets 授權失敗: {error[1]}", remaining)
 
-    def get_plant_by_id(self, plant_id):
-        with self.engine.connect() as conn:
-            return conn.execute(text("SELECT * FROM plants WHERE id=:id"), {"id": plant_id}).first()
+    def resubmit_create_worksheet(self, mac_address, only_failed=False):
+        """
+        重新送出建立工作表的背景工作；已有進行中的工作時不重複送出。
+        only_failed=True 時只在最近一次工作失敗時送出。回傳新的 job_id 或 None。
+        """
+        job = self.jobs.latest('create_worksheet', mac_address)
+        if job is not None and job["status"] in ('pending', 'running'):
+            return None
+        if only_failed and (job is None or job["status"] != 'failed'):
+            return None
+        logging.info(f"重新送出建立工作表 '{mac_address}' 的背景工作。")
+        return self.jobs.submit('create_worksheet', {"mac_address": mac_address}, key=mac_address)
 
-    def update_plant(self, plant_id, name, photo_file):
-        with self.engine.connect() as conn:
-            plant = self.get_plant_by_id(plant_id)
-            if not plant:
-                raise ValueError("找不到植物")
-
-            photo_path = plant.photo_path
-            if photo_file and photo_file.filename:
-                # 如果有舊照片且位於上傳資料夾，則刪除
-                if photo_path and photo_path.startswith('/static/uploads/'):
-                    old_photo_filename = os.path.basename(photo_path)
-                    old_photo_path = os.path.join(self.upload_folder, old_photo_filename)
-                    if os.path.exists(old_photo_path):
-                        os.remove(old_photo_path)
-                        logging.info(f"已刪除舊照片: {old_photo_path}")
-
-                # 儲存新照片
-                filename = secure_filename(photo_file.filename)
-                file_path = os.path.join(self.upload_folder, filename)
-                photo_file.save(file_path)
-                photo_path = f"/static/uploads/{filename}"
-
-            # 更新資料庫
-            conn.execute(text("UPDATE plants SET name = :name, photo_path = :photo_path WHERE id = :id"),
-                         {"name": name, "photo_path": photo_path, "id": plant_id})
-            conn.commit()
-            logging.info(f"植物 ID {plant_id} 的資料已更新。")
+    def request_initial_sync(self, sheet_id, mac_address):
+        """
+        此裝置從未同步過時，由背景工作從 Google Sheets 匯入一次（之後由 update.py 增量同步），
+        請求不直接呼叫 Google API。每台裝置只送出一次；工作失敗或工作表不存在時不再重送。
+        """
+        if mac_address in self.initial_sync_requested:
+            return None
+        self.initial_sync_requested.add(mac_address)
+        if self.jobs.latest('sync_worksheet', mac_address) is not None:
+            return None
+        return self.jobs.submit('sync_worksheet', {"sheet_id": sheet_id, "mac_address": mac_address}, key=mac_address)
+
+    def run_sync_worksheet_job(self, payload):
+        mac_address = payload["mac_address"]
+        if self.get_plant_by_mac(mac_address) is None or self.get_sync_state(mac_address) is not None:
+            return
+        self.defer_while_unauthorized()
+        results = self.sync_worksheets([{"sheet_id": payload["sheet_id"], "mac_address": mac_address}])
+        if mac_address not in results and self._auth_error is not None:
+            raise RuntimeError(f"無法讀取工作表 '{mac_address}': {self._auth_error[1]}")
+
+    def run_create_worksheet_job(self, payload):
+        mac_address = payload["mac_address"]
+        if self.get_plant_by_mac(mac_address) is None:
+            logging.info(f"植物 '{mac_address}' 已被刪除，略過建立工作表。")
+            return
+        self.defer_while_unauthorized()
+        if not self.create_worksheet(mac_address):
+            raise RuntimeError(f"無法建立 Google Sheets 工作表 '{mac_address}'")
+
+    def run_delete_worksheet_job(self, payload):
+        mac_address = payload["mac_address"]
+        if self.get_plant_by_mac(mac_address) is not None:
+            logging.info(f"裝置 '{mac_address}' 已重新配對，略過刪除工作表。")
+            return
+        self.defer_while_unauthorized()
+        sheet = self.get_spreadsheet(payload["sheet_id"])
+        try:
+            worksheet = self.google_call("worksheet", sheet.worksheet, mac_address)
+        except gspread.exceptions.WorksheetNotFound:
+            logging.warning(f"Google Sheets 工作表 '{mac_address}' 不存在，略過刪除。")
+            return
+        self.google_call("del_worksheet", sheet.del_worksheet, worksheet)
+        logging.info(f"已成功刪除 Google Sheets 工作表: {mac_address}")
 
     def create_worksheet(self, identifier):
+        self.invalidate_plant_cache(identifier)
         try:
-            sheet = self.client.open_by_key(self.fixed_sheet_id)
+            sheet = self.get_spreadsheet(self.fixed_sheet_id)
             try:
-                sheet.worksheet(identifier)
+                self.google_call("worksheet", sheet.worksheet, identifier)
                 logging.warning(f"工作表 '{identifier}' 已存在，不重複創建。")
                 return True
             except gspread.exceptions.WorksheetNotFound:
-                ws = sheet.add_worksheet(title=identifier, rows="100", cols="20")
-                ws.insert_row(["時間", "環境溫度", "環境濕度", "土壤濕度", "光照度"], index=1)
+                ws = self.google_call("add_worksheet", sheet.add_worksheet, title=identifier, rows="100", cols="20")
+                self.google_call("insert_row", ws.insert_row, SHEET_HEADERS, index=1)
                 return True
         except gspread.exceptions.APIError as e:
             logging.error(f"Google Sheets API Error: {e}")
             return False
     
-    def get_plant_data(self, sheet_id, worksheet_name, start_date=None, end_date=None):
+    def parse_sheet_rows(self, headers, rows):
+        """
+        將工作表的原始字串列轉換為 sensor_readings 格式的 DataFrame（ts 與數值欄位）。
+        """
+        headers = [h.strip() for h in headers]
+        # gspread 會省略列尾的空白儲存格，先補齊長度
+        rows = [row + [''] * (len(headers) - len(row)) for row in rows]
+        df = pd.DataFrame([row[:len(headers)] for row in rows], columns=headers)
+        if "時間" not in df.columns:
+            return pd.DataFrame(columns=["ts", *SENSOR_COLUMNS.values()])
+
+        readings = pd.DataFrame()
+        times = pd.to_datetime(df["時間"], format=SHEET_TIME_FORMAT, errors="coerce")
+        times = times.dt.tz_localize(TAIPEI_TZ, ambiguous='infer')
+        readings["ts"] = (times - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+        for sheet_col, col in SENSOR_COLUMNS.items():
+            values = df[sheet_col] if sheet_col in df.columns else None
+            readings[col] = pd.to_numeric(values, errors='coerce').astype(float) if values is not None else float('nan')
+        readings = readings.dropna(subset=["ts"])
+        readings["ts"] = readings["ts"].astype('int64')
+        return readings
+
+    def store_readings(self, mac_address, readings, conn=None, mirror=False):
+        """
+        以單一交易批次寫入感測數據，(mac_address, ts) 重複的資料會被略過。
+        傳入 conn 時沿用呼叫端的交易，由呼叫端在提交後呼叫 invalidate_plant_cache，
+        避免同時進行的查詢把提交前的數據重新放進快取；mirror=True 表示稍後由 SheetsMirror 附加到 Google Sheets。
+        早於封存範圍（archived_until）或原始數據保留期限的數據已計入彙總表，也不再從 sensor_readings 讀取，
+        重新寫入會被彙總觸發器重複累加，因此一律略過。
+        """
+        if readings is None or len(readings) == 0:
+            return 0
+        if conn is None:
+            with self.engine.begin() as conn:
+                inserted = self.store_readings(mac_address, readings, conn=conn, mirror=mirror)
+            if inserted:
+                self.invalidate_plant_cache(mac_address)
+                self.apply_water_rules([mac_address])
+            return inserted
+
+        floor_ts = max(self.get_archived_until(conn, mac_address), self.retention_cutoff(self.raw_retention_days))
+        if floor_ts:
+            expired = readings["ts"] < floor_ts
+            if expired.any():
+                logging.info(f"略過 {int(expired.sum())} 筆早於封存或保留期限的數據 ({mac_address})。")
+                readings = readings[~expired]
+                if not len(readings):
+                    return 0
+
+        columns = ["ts", *SENSOR_COLUMNS.values()]
+        frame = readings[columns].astype(object)
+        frame = frame.where(frame.notna(), None)
+        pending_mirror = 1 if mirror else 0
+        params = [dict(zip(columns, row), mac_address=mac_address, pending_mirror=pending_mirror)
+                  for row in frame.itertuples(index=False, name=None)]
+        result = conn.execute(text("""
+            INSERT OR IGNORE INTO sensor_readings (mac_address, ts, temperature, humidity, soil_moisture, light, pending_mirror)
+            VALUES (:mac_address, :ts, :temperature, :humidity, :soil_moisture, :light, :pending_mirror)
+        """), params)
+        logging.info(f"已寫入 {result.rowcount} 筆感測數據 ({mac_address})。")
+        if result.rowcount:
+            self.update_latest_reading(mac_address, params[int(frame["ts"].astype('int64').values.argmax())], conn)
+            self.update_rolling_stats(mac_address, params, conn)
+            self.shared.publish('readings', mac_address, conn)
+        return result.rowcount
+
+    def build_ingest_frame(self, records, now=None):
+        """
+        將 /api/ingest 收到的數據列轉為 DataFrame（mac_address、ts 與數值欄位）。
+        時間依序取 ts（UTC epoch 秒）、time（工作表格式的台北時間或 ISO 8601）、
+        age（幾秒前量測），都沒有時使用伺服器收到的時間。
+        數值可用英文欄位名、中文欄位名，或 UNO 的 data 字串「溫度,濕度,土壤濕度,光照度」。
+        回傳 (有效的數據列, 無效的列數)。以下的列視為無效，不會寫入：mac_address 缺少、空白或不是字串；
+        ts、time 或 age 有值但無法解析（ts 不可為布林值）；量測時間不在 INGEST_MIN_TS 到伺服器時間加 INGEST_MAX_FUTURE 之間。
+        """
+        now = time.time() if now is None else now
+        df = pd.DataFrame(records)
+        if "mac_address" not in df.columns:
+            raise ValueError("缺少 mac_address")
+
+        invalid = ~df["mac_address"].map(lambda mac: isinstance(mac, str) and mac.strip() != "")
+        readings = pd.DataFrame({"mac_address": df["mac_address"].where(~invalid, "").astype(str)})
+        def number(column):
+            values = df[column]
+            parsed = pd.to_numeric(values.where(~values.map(lambda v: isinstance(v, bool))), errors='coerce')
+            return parsed, values.notna() & parsed.isna()
+
+        ts = pd.Series(float(now), index=df.index)
+        if "age" in df.columns:
+            age, bad = number("age")
+            invalid |= bad
+            ts = ts.where(age.isna(), now - age)
+        if "time" in df.columns:
+            raw = df["time"].astype("string")
+            times = pd.to_datetime(raw, format=SHEET_TIME_FORMAT, errors='coerce').dt.tz_localize(TAIPEI_TZ).dt.tz_convert('UTC')
+            iso = pd.to_datetime(raw.where(times.isna()), format='ISO8601', utc=True, errors='coerce')
+            times = times.fillna(iso)
+            seconds = (times - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+            invalid |= raw.notna().astype(bool) & seconds.isna()
+            ts = ts.where(seconds.isna(), seconds)
+        if "ts" in df.columns:
+            epoch, bad = number("ts")
+            invalid |= bad
+            ts = ts.where(epoch.isna(), epoch)
+        invalid |= ~ts.between(INGEST_MIN_TS, now + INGEST_MAX_FUTURE)
+        readings["ts"] = ts.where(~invalid, 0).astype('int64')
+
+        if "data" in df.columns:
+            split = df["data"].fillna("").astype(str).str.split(",", expand=True).reindex(columns=range(len(SENSOR_COLUMNS)))
+        for i, (sheet_col, col) in enumerate(SENSOR_COLUMNS.items()):
+            values = None
+            if col in df.columns:
+                values = df[col]
+            elif sheet_col in df.columns:
+                values = df[sheet_col]
+            if "data" in df.columns:
+                values = split[i] if values is None else values.fillna(split[i])
+            readings[col] = pd.to_numeric(values, errors='coerce').astype(float) if values is not None else float('nan')
+        return readings[~invalid], int(invalid.sum())
+
+    def ingest_readings(self, readings):
+        """
+        將多台裝置的數據（含 mac_address 欄位的 DataFrame）在單一交易中寫入，
+        並標記為待鏡像到 Google Sheets。回傳 {mac_address: 新增筆數}。
+        """
+        results = {}
+        with self.engine.begin() as conn:
+            for mac_address, group in readings.groupby("mac_address", sort=False):
+                results[mac_address] = self.store_readings(mac_address, group, conn=conn, mirror=True)
+        for mac_address, inserted in results.items():
+            if inserted:
+                self.invalidate_plant_cache(mac_address)
+        self.apply_water_rules([mac for mac, inserted in results.items() if inserted])
+        return results
+
+    def update_rolling_stats(self, mac_address, readings, conn):
+        """
+        以新寫入的數據（store_readings 的參數列）更新滾動統計；
+        該裝置還沒有視窗時，先從資料庫載入最近 stats_window 筆（走主鍵索引，與歷史長度無關）。
+        """
+        if mac_address not in self.rolling_stats:
+            columns = ", ".join(["ts", *SENSOR_COLUMNS.values()])
+            recent = conn.execute(
+                text(f"SELECT {columns} FROM sensor_readings WHERE mac_address=:mac_address ORDER BY ts DESC LIMIT :limit"),
+                {"mac_address": mac_address, "limit": self.rolling_stats.size}).mappings().all()
+            self.rolling_stats.update(mac_address, recent)
+        self.rolling_stats.update(mac_address, readings)
+
+    def get_rolling_stats(self, mac_address):
+        """
+        回傳各數值欄位的滾動統計（筆數、最新值、平均、最小、最大、每小時斜率）；沒有數據時回傳 None。
+        """
+        if mac_address not in self.rolling_stats:
+            with self.engine.connect() as conn:
+                self.update_rolling_stats(mac_address, [], conn)
+        return self.rolling_stats.summary(mac_address)
+
+    def load_water_rules(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("SELECT * FROM water_rules")).mappings().all()
+        return {row["mac_address"]: dict(row) for row in rows}
+
+    def set_water_rule(self, mac_address, enabled, threshold, cooldown=None, commands=()):
+        """
+        寫入自動澆水規則；commands 會在同一個交易中加入裝置的佇列，任一步失敗時規則與指令都不會生效。
+        回傳 (規則, 含 seq 的指令)。
+        """
+        rule = {"mac_address": mac_address, "enabled": 1 if enabled else 0, "threshold": float(threshold),
+                "cooldown": int(self.water_rule_cooldown if cooldown is None else cooldown), "updated_at": int(time.time())}
+        queued = []
+        with self.engine.begin() as conn:
+            if commands:
+                queued = self.enqueue_commands(mac_address, commands, conn=conn)
+            conn.execute(text("""
+                INSERT INTO water_rules (mac_address, enabled, threshold, cooldown, updated_at)
+                VALUES (:mac_address, :enabled, :threshold, :cooldown, :updated_at)
+                ON CONFLICT(mac_address) DO UPDATE SET
+                    enabled = excluded.enabled, threshold = excluded.threshold,
+                    cooldown = excluded.cooldown, updated_at = excluded.updated_at
+            """), rule)
+            self.shared.publish('water_rules', mac_address, conn)
+            row = conn.execute(text("SELECT * FROM water_rules WHERE mac_address=:mac_address"), {"mac_address": mac_address}).mappings().first()
+        self.water_rules[mac_address] = dict(row)
+        return self.water_rules[mac_address], queued
+
+    def apply_water_rules(self, mac_addresses):
+        """
+        新數據寫入後評估自動澆水規則：土壤濕度的最新值與滾動平均都低於閾值、最新數據不超過 water_rule_max_age 秒，
+        且距離上次觸發已超過冷卻時間時，加入立即澆水指令（case 3）。只讀取記憶體中的視窗，成本與歷史長度無關。
+        冷卻時間以資料庫的條件式更新判斷，多個程序同時評估時只會觸發一次；裝置離線時佇列中已有尚未送達的
+        澆水指令就不再加入，避免重新連線後連續澆水。
+        """
+        now = int(time.time())
+        for mac_address in mac_addresses:
+            rule = self.water_rules.get(mac_address)
+            if not rule or not rule["enabled"]:
+                continue
+            if rule["last_triggered_at"] is not None and now - rule["last_triggered_at"] < rule["cooldown"]:
+                continue
+            with self.rolling_stats.lock:
+                window = self.rolling_stats.window(mac_address, "soil_moisture")
+                if window is None or not len(window) or now - window.last_ts > self.water_rule_max_age:
+                    continue
+                last, mean = window.last, window.mean
+            if last >= rule["threshold"] or mean >= rule["threshold"]:
+                continue
+
+            with self.engine.begin() as conn:
+                claimed = conn.execute(text("""
+                    UPDATE water_rules SET last_triggered_at = :now
+                    WHERE mac_address = :mac_address AND enabled = 1
+                      AND (last_triggered_at IS NULL OR last_triggered_at <= :now - cooldown)
+                      AND NOT EXISTS (SELECT 1 FROM device_commands
+                                      WHERE device_commands.mac_address = :mac_address AND case_no = 3)
+                """), {"now": now, "mac_address": mac_address}).rowcount
+                if claimed:
+                    self.enqueue_commands(mac_address, [{"case": 3, "value": 1}], conn=conn)
+            rule["last_triggered_at"] = now
+            if claimed:
+                # 喚醒本程序中等待指令的裝置（其他程序由 enqueue_commands 發布的事件喚醒）
+                self.shared.dispatch('device', mac_address)
+                self.metrics.inc("water_rule_triggers_total")
+                logging.info(f"自動澆水規則觸發：{mac_address} 土壤濕度 {last}（平均 {mean:.1f}）低於 {rule['threshold']}")
+
+    def load_latest_readings(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("SELECT * FROM latest_readings")).mappings().all()
+        return {row["mac_address"]: self.reading_to_record(row) for row in rows}
+
+    def update_latest_reading(self, mac_address, reading, conn):
+        """
+        只有比目前索引更新的數據才會覆蓋索引，資料表與記憶體同步更新。
+        """
+        with self.latest_lock:
+            current = self.latest_readings.get(mac_address)
+            if current is not None and current["ts"] >= reading["ts"]:
+                return
+            conn.execute(text("""
+                INSERT INTO latest_readings (mac_address, ts, temperature, humidity, soil_moisture, light)
+                VALUES (:mac_address, :ts, :temperature, :humidity, :soil_moisture, :light)
+                ON CONFLICT(mac_address) DO UPDATE SET
+                    ts = excluded.ts, temperature = excluded.temperature, humidity = excluded.humidity,
+                    soil_moisture = excluded.soil_moisture, light = excluded.light
+                WHERE excluded.ts > latest_readings.ts
+            """), {**reading, "mac_address": mac_address})
+            self.latest_readings[mac_address] = self.reading_to_record(reading)
+
+    def reading_to_record(self, reading):
+        record = {"ts": reading["ts"], "時間": datetime.fromtimestamp(reading["ts"], tz=timezone.utc)}
+        for sheet_col, col in SENSOR_COLUMNS.items():
+            record[sheet_col] = reading[col]
+        return record
+
+    def get_latest_reading(self, mac_address):
+        """
+        回傳該裝置最新一筆數據（不含內部用的 ts 欄位），沒有數據時回傳 None。
+        """
+        record = self.latest_readings.get(mac_address)
+        if record is None:
+            return None
+        return {k: v for k, v in record.items() if k != "ts"}
+
+    def fetch_latest_reading(self, plant):
+        """
+        與首頁總覽相同：本地索引沒有此裝置的數據時，讀取工作表尾端補上（60 秒內不重複讀取）。
+        """
+        mac_address = plant["mac_address"]
+        if mac_address not in self.latest_readings and self.sheet_tail_cache.get(mac_address) is None:
+            self.fetch_sheet_tails([plant])
+        return self.get_latest_reading(mac_address)
+
+    def get_overview(self):
+        """
+        首頁總覽：所有植物與其最新數據。最新數據來自本地索引；
+        本地沒有數據的植物，以每個試算表一次批次讀取各工作表的尾端列補上。
+        """
+        plants = self.get_all_plants()
+        missing = [p for p in plants if p["mac_address"] not in self.latest_readings
+                   and self.sheet_tail_cache.get(p["mac_address"]) is None]
+        if missing:
+            self.fetch_sheet_tails(missing)
+
+        with self.latest_lock:
+            latest = pd.DataFrame([{"mac_address": mac, **record} for mac, record in self.latest_readings.items()],
+                                  columns=["mac_address", "時間", *SENSOR_COLUMNS])
+        merged = pd.DataFrame(plants, columns=["id", "name", "photo_path", "mac_address"]).merge(latest, on="mac_address", how="left")
+        reading_columns = ["時間", *SENSOR_COLUMNS]
+        readings = merged[reading_columns].astype(object).where(merged[reading_columns].notna(), None).to_dict(orient="records")
+        has_reading = merged["時間"].notna().tolist()
+        return [{"plant_id": int(plant_id), "name": name, "photo_path": photo_path, "mac_address": mac,
+                 "reading": reading if ok else None}
+                for plant_id, name, photo_path, mac, reading, ok in zip(
+                    merged["id"], merged["name"], merged["photo_path"], merged["mac_address"], readings, has_reading)]
+
+    def fetch_sheet_tails(self, plants):
+        """
+        以一次 fetch_sheet_metadata 取得各工作表的列數，再以一次 values_batch_get 讀取所有工作表最後
+        SHEET_TAIL_ROWS 列；列數較少、尾端仍是空白的工作表，再以一次批次讀取完整內容。
+        讀到的最新一筆寫入最新數據索引。
+        """
+        by_sheet = {}
+        for plant in plants:
+            by_sheet.setdefault(plant["sheet_id"] or self.fixed_sheet_id, []).append(plant["mac_address"])
+
+        frames = []
+        for sheet_id, macs in by_sheet.items():
+            try:
+                sheet = self.get_spreadsheet(sheet_id)
+                metadata = self.google_call("fetch_sheet_metadata", sheet.fetch_sheet_metadata)
+                row_counts = {s["properties"]["title"]: s["properties"]["gridProperties"]["rowCount"] for s in metadata.get("sheets", [])}
+                macs = [mac for mac in macs if mac in row_counts]
+                tails = {mac: f"'{mac}'!A{max(2, row_counts[mac] - SHEET_TAIL_ROWS + 1)}:E{row_counts[mac]}" for mac in macs}
+                fetched = self.batch_get_rows(sheet, tails)
+                # 工作表的格數比資料多時尾端是空白的，改讀完整範圍（只發生在資料很少的工作表）
+                empty = {mac: f"'{mac}'!A2:E{row_counts[mac]}" for mac in macs if not fetched.get(mac) and row_counts[mac] > SHEET_TAIL_ROWS}
+                if empty:
+                    fetched.update(self.batch_get_rows(sheet, empty))
+            except Exception as e:
+                logging.error(f"讀取試算表 {sheet_id} 的工作表尾端失敗: {e}")
+                continue
+            for mac, rows in fetched.items():
+                if rows:
+                    frames.append(pd.DataFrame({"mac_address": mac, "row": rows}))
+
+        for plant in plants:
+            self.sheet_tail_cache.set(plant["mac_address"], True)
+        if not frames:
+            return
+
+        # 所有工作表的資料列一次解析，再取每台裝置時間最新的一筆
+        rows = pd.concat(frames, ignore_index=True)
+        readings = self.parse_sheet_rows(SHEET_HEADERS, rows["row"].tolist())
+        readings["mac_address"] = rows["mac_address"].loc[readings.index].values
+        newest = readings.loc[readings.groupby("mac_address")["ts"].idxmax()]
+        with self.engine.begin() as conn:
+            for reading in newest.to_dict(orient="records"):
+                mac_address = reading.pop("mac_address")
+                self.update_latest_reading(mac_address, {k: (None if pd.isna(v) else v) for k, v in reading.items()}, conn)
+
+    def batch_get_rows(self, sheet, ranges):
+        if not ranges:
+            return {}
+        response = self.google_call("values_batch_get", sheet.values_batch_get, list(ranges.values()))
+        return {mac: value_range.get('values', []) for mac, value_range in zip(ranges, response.get('valueRanges', []))}
+
+    def get_sync_state(self, mac_address):
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT * FROM sync_state WHERE mac_address=:mac_address"),
+                                {"mac_address": mac_address}).first()
+
+    def apply_sync_rows(self, mac_address, last_row, rows):
+        """
+        將工作表中 last_row 之後的新列寫入本地，並在同一個交易中推進同步水位。
+        """
+        with self.metrics.timer("sheet_parse_duration_seconds", phase="parse"):
+            readings = self.parse_sheet_rows(SHEET_HEADERS, rows)
+        self.metrics.inc("sheet_rows_parsed_total", len(rows))
+        with self.engine.begin() as conn:
+            inserted = self.store_readings(mac_address, readings, conn=conn)
+            conn.execute(text("""
+                INSERT INTO sync_state (mac_address, last_row, last_ts, synced_at)
+                VALUES (:mac_address, :last_row, :last_ts, :synced_at)
+                ON CONFLICT(mac_address) DO UPDATE SET
+                    last_row = excluded.last_row,
+                    last_ts = COALESCE(MAX(sync_state.last_ts, excluded.last_ts), sync_state.last_ts, excluded.last_ts),
+                    synced_at = excluded.synced_at
+            """), {
+                "mac_address": mac_address,
+                "last_row": last_row + len(rows),
+                "last_ts": int(readings["ts"].max()) if len(readings) else None,
+                "synced_at": int(time.time()),
+            })
+        if inserted:
+            self.invalidate_plant_cache(mac_address)
+            self.apply_water_rules([mac_address])
+        return inserted
+
+    def sync_worksheets(self, plants=None):
+        """
+        以水位為基準增量同步工作表：每個試算表只發出一次批次的區間讀取，
+        只下載各工作表水位之後的新列。回傳 {mac_address: 新增筆數}。
+        """
+        if plants is None:
+            plants = self.get_all_plants()
+        with self.engine.connect() as conn:
+            last_rows = {r.mac_address: r.last_row for r in conn.execute(text("SELECT mac_address, last_row FROM sync_state"))}
+
+        by_sheet = {}
+        for plant in plants:
+            by_sheet.setdefault(plant["sheet_id"] or self.fixed_sheet_id, []).append(plant["mac_address"])
+
+        results = {}
+        for sheet_id, macs in by_sheet.items():
+            try:
+                sheet = self.get_spreadsheet(sheet_id)
+            except Exception as e:
+                logging.error(f"開啟試算表 {sheet_id} 失敗: {e}")
+                continue
+
+            ranges = {mac: f"'{mac}'!A{last_rows.get(mac, 1) + 1}:E" for mac in macs}
+            try:
+                response = self.google_call("values_batch_get", sheet.values_batch_get, list(ranges.values()))
+                fetched = {mac: value_range.get('values', []) for mac, value_range in zip(macs, response.get('valueRanges', []))}
+            except gspread.exceptions.APIError as e:
+                # 任一工作表不存在會讓整批讀取失敗，改為逐一讀取
+                logging.warning(f"批次讀取失敗，改為逐一讀取: {e}")
+                fetched = {}
+                for mac, cell_range in ranges.items():
+                    try:
+                        fetched[mac] = self.google_call("values_get", sheet.values_get, cell_range).get('values', [])
+                    except Exception as e:
+                        logging.error(f"讀取工作表 '{mac}' 失敗: {e}")
+
+            for mac, rows in fetched.items():
+                try:
+                    results[mac] = self.apply_sync_rows(mac, last_rows.get(mac, 1), rows)
+                except Exception as e:
+                    logging.error(f"同步工作表 '{mac}' 失敗: {e}")
+        return results
+
+    def iter_readings(self, mac_address, start_ts, end_ts, chunk_size=EXPORT_CHUNK_ROWS):
+        """
+        依時間順序分批產生 [start_ts, end_ts] 的數據，每批為 (ts, 溫度, 濕度, 土壤濕度, 光照度) tuple 的列表。
+        封存的部分一次讀取一個月份檔；sensor_readings 以 ts 分頁（ts > 上一批最後一筆），
+        每批使用新的短連線，匯出再長也不會一直佔用連線池或讀取交易。
+        """
+        columns = list(SENSOR_COLUMNS.values())
+        with self.engine.connect() as conn:
+            archived_until = self.get_archived_until(conn, mac_address)
+
+        if start_ts < archived_until:
+            for year, month in self.archive.months_between(start_ts, min(end_ts, archived_until - 1)):
+                frame = self.archive.read(mac_address, max(start_ts, month_start_ts(year, month)),
+                                          min(end_ts, archived_until - 1, month_start_ts(year, month + 1) - 1), columns)
+                frame = frame.sort_values("ts")
+                rows = list(zip(frame["ts"].astype('int64').tolist(), *(frame[col].tolist() for col in columns)))
+                for i in range(0, len(rows), chunk_size):
+                    yield rows[i:i + chunk_size]
+
+        last_ts = max(start_ts, archived_until) - 1
+        while True:
+            with self.engine.connect() as conn:
+                rows = conn.execute(text(f"""
+                    SELECT ts, {", ".join(columns)} FROM sensor_readings
+                    WHERE mac_address=:mac_address AND ts > :last_ts AND ts <= :end_ts ORDER BY ts LIMIT :limit
+                """), {"mac_address": mac_address, "last_ts": last_ts, "end_ts": end_ts, "limit": chunk_size}).all()
+            if not rows:
+                return
+            yield [tuple(row) for row in rows]
+            if len(rows) < chunk_size:
+                return
+            last_ts = rows[-1].ts
+
+    def readings_to_records(self, readings):
+        """
+        將 sensor_readings 的查詢結果轉回 API 使用的欄位格式（時間為 UTC）。
+        """
+        df = pd.DataFrame({"時間": pd.to_datetime(readings["ts"], unit='s', utc=True)})
+        for sheet_col, col in SENSOR_COLUMNS.items():
+            df[sheet_col] = readings[col].values
+        return df.to_dict(orient="records")
+
+    def aggregate_readings(self, conn, mac_address, start_ts, end_ts, bucket, metric):
+        """
+        以 SQL GROUP BY 在資料庫內完成分組，回傳每個分組的 sum/min/max/count。
+        """
+        column = SENSOR_COLUMNS[metric]
+        return pd.read_sql_query(text(f"""
+            SELECT {BUCKET_EXPRESSIONS[bucket]} AS bucket,
+                   SUM({column}) AS sum, MIN({column}) AS min, MAX({column}) AS max, COUNT({column}) AS count
+            FROM sensor_readings
+            WHERE mac_address=:mac_address AND ts BETWEEN :start_ts AND :end_ts
+            GROUP BY bucket
+        """), conn, params={"mac_address": mac_address, "start_ts": start_ts, "end_ts": end_ts})
+
+    def aggregate_range(self, conn, mac_address, start_ts, end_ts, bucket, metric, archived_until, resolutions):
+        """
+        [start_ts, end_ts] 中完整涵蓋的小時/日從最粗的彙總表讀取，頭尾不完整的部分改用較細的彙總表，
+        最後才讀原始數據（sensor_readings 與 Parquet 封存），查詢成本與取樣頻率無關。
+        較細的資料已依保留期限刪除的部分，以涵蓋該時間的整個區間代替。
+        回傳 sum/min/max/count 的部分聚合結果列表。
+        """
+        if start_ts > end_ts:
+            return []
+        if not resolutions:
+            partials = [self.aggregate_readings(conn, mac_address, max(start_ts, archived_until), end_ts, bucket, metric)]
+            archived = self.archive.read(mac_address, start_ts, min(end_ts, archived_until - 1), [SENSOR_COLUMNS[metric]])
+            if len(archived):
+                partials.append(self.aggregate_frame(archived, bucket, metric))
+            return partials
+
+        table, size = ROLLUP_TABLES[resolutions[0]]
+        first = start_ts + (-(start_ts + TAIPEI_OFFSET)) % size        # 第一個完整區間的開始
+        last = end_ts + 1 - (end_ts + 1 + TAIPEI_OFFSET) % size         # 最後一個完整區間的結束（不含）
+        # 較細的資料已依保留期限刪除時，頭尾改用涵蓋該時間的整個區間
+        expired_before = self.retention_cutoff(self.hourly_retention_days if len(resolutions) > 1 else self.raw_retention_days)
+        if start_ts < expired_before and first > start_ts:
+            first -= size
+        if end_ts < expired_before and last <= end_ts:
+            last += size
+        if first >= last:
+            return self.aggregate_range(conn, mac_address, start_ts, end_ts, bucket, metric, archived_until, resolutions[1:])
+        return [
+            self.aggregate_rollups(conn, table, mac_address, first, last, bucket, metric),
+            *self.aggregate_range(conn, mac_address, start_ts, first - 1, bucket, metric, archived_until, resolutions[1:]),
+            *self.aggregate_range(conn, mac_address, last, end_ts, bucket, metric, archived_until, resolutions[1:]),
+        ]
+
+    def aggregate_rollups(self, conn, table, mac_address, start_ts, end_ts, bucket, metric):
+        """
+        從彙總表讀取 bucket_ts 介於 [start_ts, end_ts) 的區間並依 bucket 分組（分組式以 bucket_ts 作為 ts 計算）。
+        """
+        return pd.read_sql_query(text(f"""
+            SELECT {BUCKET_EXPRESSIONS[bucket]} AS bucket,
+                   SUM(sum) AS sum, MIN(min) AS min, MAX(max) AS max, SUM(count) AS count
+            FROM (SELECT bucket_ts AS ts, sum, min, max, count FROM {table}
+                  WHERE mac_address=:mac_address AND metric=:metric AND bucket_ts >= :start_ts AND bucket_ts < :end_ts)
+            GROUP BY bucket
+        """), conn, params={"mac_address": mac_address, "metric": SENSOR_COLUMNS[metric], "start_ts": start_ts, "end_ts": end_ts})
+
+    def aggregate_frame(self, readings, bucket, metric):
+        """
+        與 aggregate_readings 相同的分組，用於已載入的 DataFrame（例如 Parquet 封存）。
+        """
+        column = SENSOR_COLUMNS[metric]
+        local_time = pd.to_datetime(readings["ts"], unit='s', utc=True).dt.tz_convert(TAIPEI_TZ)
+        grouped = readings[column].groupby(BUCKET_ACCESSORS[bucket](local_time).rename("bucket"))
+        return grouped.agg(["sum", "min", "max", "count"]).reset_index()
+
+    def finalize_aggregates(self, partials):
+        """
+        合併多個來源的部分聚合結果，回傳每個分組的 mean/min/max/count。
+        """
+        partials = [partial for partial in partials if len(partial)]
+        if not partials:
+            return []
+        grouped = pd.concat(partials, ignore_index=True).groupby("bucket").agg(
+            {"sum": "sum", "min": "min", "max": "max", "count": "sum"}).reset_index()
+        grouped = grouped[grouped["count"] > 0].sort_values("bucket")
+        grouped["mean"] = grouped["sum"] / grouped["count"]
+        grouped["bucket"] = grouped["bucket"].astype(int)
+        grouped["count"] = grouped["count"].astype(int)
+        return grouped[["bucket", "mean", "min", "max", "count"]].to_dict(orient="records")
+
+    def get_plant_data(self, sheet_id, worksheet_name, start_date=None, end_date=None, bucket=None, metric=None):
+        if bucket is not None:
+            if bucket not in BUCKET_EXPRESSIONS:
+                raise ValueError(f"不支援的分組方式: {bucket}")
+            if metric not in SENSOR_COLUMNS:
+                raise ValueError(f"不支援的數據類型: {metric}")
+            if not (start_date and end_date):
+                raise ValueError("聚合模式需要指定 start 與 end")
         try:
-            sheet = self.client.open_by_key(sheet_id)
-            all_values = sheet.values_get(f"{worksheet_name}!A:Z")
-            values = all_values.get('values', [])
-            if not values or len(values) < 2:
-                return []
-            
-            headers = [h.strip() for h in values[0]]
-            rows = values[1:]
-            df = pd.DataFrame(rows, columns=headers)
-            
-            numeric_cols = ["環境溫度", "環境濕度", "土壤濕度", "光照度"]
-            for col in numeric_cols:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-            
-            taipei_tz = pytz.timezone('Asia/Taipei')
-            df["時間"] = pd.to_datetime(df["時間"], format="%Y/%m/%d-%H:%M:%S", errors="coerce")
-            df = df.dropna(subset=["時間"])
-            df["時間"] = df["時間"].dt.tz_localize(taipei_tz, ambiguous='infer')
-            df["時間"] = df["時間"].dt.tz_convert('UTC')
+            # 此裝置從未同步過時，由背景工作從 Google Sheets 匯入一次；之後由 update.py 增量同步
+            if self.get_sync_state(worksheet_name) is None:
+                self.request_initial_sync(sheet_id, worksheet_name)
 
+            start_ts = end_ts = None
             if start_date and end_date:
-                start_date_utc = pd.to_datetime(start_date, utc=True)
-                end_date_utc = pd.to_datetime(end_date, utc=True)
-                
-                df_time_utc = df['時間'].dt.tz_convert('UTC')
-                filtered_df = df[(df_time_utc >= start_date_utc) & (df_time_utc <= end_date_utc)].copy()
-                logging.info(f"過濾後的資料筆數: {len(filtered_df)}")
-                return filtered_df.to_dict(orient="records")
-            
+                start_ts = math.ceil(pd.to_datetime(start_date, utc=True).timestamp())
+                end_ts = math.floor(pd.to_datetime(end_date, utc=True).timestamp())
             else:
-                latest_data = df.sort_values(by='時間', ascending=False).head(1).to_dict(orient="records")
-                logging.info(f"回傳最新 {len(latest_data)} 筆資料。")
-                return latest_data
+                latest = self.fetch_latest_reading({"sheet_id": sheet_id, "mac_address": worksheet_name})
+                return [latest] if latest else []
+            key = (worksheet_name, start_ts, end_ts, bucket, metric)
+            data = self.data_cache.get_or_load(key, lambda: self.timed_query_plant_data(worksheet_name, start_ts, end_ts, bucket, metric))
+            self.metrics.observe("plant_data_rows", len(data), mode="bucket" if bucket else "raw")
+            return data
 
         except Exception as e:
             logging.error(f"取得植物資料錯誤: {e}")
             return []
+
+    def timed_query_plant_data(self, worksheet_name, start_ts, end_ts, bucket=None, metric=None):
+        with self.metrics.timer("plant_data_query_duration_seconds", mode="bucket" if bucket else "raw"):
+            return self.query_plant_data(worksheet_name, start_ts, end_ts, bucket, metric)
+
+    def query_plant_data(self, worksheet_name, start_ts, end_ts, bucket=None, metric=None):
+        """
+        archived_until 之前的數據從 Parquet 封存讀取，之後的從 sensor_readings 讀取。
+        """
+        columns = ", ".join(["ts", *SENSOR_COLUMNS.values()])
+        with self.engine.connect() as conn:
+            archived_until = self.get_archived_until(conn, worksheet_name)
+            if bucket is not None:
+                partials = self.aggregate_range(conn, worksheet_name, start_ts, end_ts, bucket, metric, archived_until,
+                                                BUCKET_ROLLUPS[bucket])
+                return self.finalize_aggregates(partials)
+
+            db_start_ts = max(start_ts, archived_until)
+            archived = self.archive.read(worksheet_name, start_ts, min(end_ts, archived_until - 1), list(SENSOR_COLUMNS.values()))
+            readings = pd.read_sql_query(
+                text(f"SELECT {columns} FROM sensor_readings WHERE mac_address=:mac_address AND ts BETWEEN :start_ts AND :end_ts ORDER BY ts"),
+                conn, params={"mac_address": worksheet_name, "start_ts": db_start_ts, "end_ts": end_ts})
+        if len(archived):
+            readings = pd.concat([archived, readings], ignore_index=True)
+        logging.info(f"過濾後的資料筆數: {len(readings)}")
+        return self.readings_to_records(readings)
+
+    def get_archived_until(self, conn, mac_address):
+        row = conn.execute(text("SELECT archived_until FROM archive_state WHERE mac_address=:mac_address"),
+                           {"mac_address": mac_address}).first()
+        return row.archived_until if row else 0
+
+    def compact_closed_months(self, mac_address):
+        """
+        將已結束月份的數據依序寫入 Parquet 封存，並從 sensor_readings 移除。
+        仍有數據等待鏡像到 Google Sheets 的月份（以及之後的月份）留待下次處理。
+        回傳封存的筆數。
+        """
+        if not self.archive.enabled:
+            return 0
+        now = datetime.now(TAIPEI_TZ)
+        current_month_ts = month_start_ts(now.year, now.month)
+        columns = ", ".join(["ts", *SENSOR_COLUMNS.values()])
+        compacted = 0
+        while True:
+            with self.engine.connect() as conn:
+                first = conn.execute(text("SELECT MIN(ts) AS ts FROM sensor_readings WHERE mac_address=:mac_address AND ts < :until"),
+                                     {"mac_address": mac_address, "until": current_month_ts}).first()
+            if first.ts is None:
+                break
+            month = datetime.fromtimestamp(first.ts, TAIPEI_TZ)
+            start_ts, end_ts = month_start_ts(month.year, month.month), month_start_ts(month.year, month.month + 1)
+            params = {"mac_address": mac_address, "start_ts": start_ts, "end_ts": end_ts}
+
+            with self.engine.begin() as conn:
+                pending = conn.execute(text("""
+                    SELECT 1 FROM sensor_readings
+                    WHERE mac_address=:mac_address AND pending_mirror = 1 AND ts >= :start_ts AND ts < :end_ts LIMIT 1
+                """), params).first()
+                if pending is not None:
+                    break
+                readings = pd.read_sql_query(
+                    text(f"SELECT {columns} FROM sensor_readings WHERE mac_address=:mac_address AND ts >= :start_ts AND ts < :end_ts"),
+                    conn, params=params)
+                self.archive.write_month(mac_address, month.year, month.month, readings)
+                conn.execute(text("DELETE FROM sensor_readings WHERE mac_address=:mac_address AND ts >= :start_ts AND ts < :end_ts"), params)
+                conn.execute(text("""
+                    INSERT INTO archive_state (mac_address, archived_until) VALUES (:mac_address, :end_ts)
+                    ON CONFLICT(mac_address) DO UPDATE SET archived_until = MAX(archived_until, excluded.archived_until)
+                """), params)
+            compacted += len(readings)
+            logging.info(f"已封存 {mac_address} {month.year}-{month.month:02d} 共 {len(readings)} 筆數據。")
+        if compacted:
+            self.invalidate_plant_cache(mac_address)
+            self.shared.publish('readings', mac_address)
+        return compacted
+
+    def rebuild_rollups(self, mac_address=None):
+        """
+        從 sensor_readings 與 Parquet 封存重新計算彙總表（未指定 mac_address 時重建全部）。
+        兩者的時間範圍不重疊，封存的部分以累加方式合併。
+        """
+        condition = "mac_address=:mac_address" if mac_address else "1 = 1"
+        params = {"mac_address": mac_address}
+        with self.engine.begin() as conn:
+            for table, size in ROLLUP_TABLES.values():
+                conn.execute(text(f"DELETE FROM {table} WHERE {condition}"), params)
+                for col in SENSOR_COLUMNS.values():
+                    conn.execute(text(f"""
+                        INSERT INTO {table} (mac_address, metric, bucket_ts, sum, min, max, count)
+                        SELECT mac_address, '{col}', ts - (ts + {TAIPEI_OFFSET}) % {size} AS bucket_ts,
+                               SUM({col}), MIN({col}), MAX({col}), COUNT({col})
+                        FROM sensor_readings WHERE {condition} AND {col} IS NOT NULL
+                        GROUP BY mac_address, bucket_ts
+                    """), params)
+            if self.archive.enabled:
+                for mac in ([mac_address] if mac_address else self.archive.mac_addresses()):
+                    for year, month in self.archive.months(mac):
+                        readings = self.archive.read(mac, month_start_ts(year, month), month_start_ts(year, month + 1) - 1,
+                                                     list(SENSOR_COLUMNS.values()))
+                        self.add_rollups(conn, mac, readings)
+        logging.info(f"已重建彙總表{f' ({mac_address})' if mac_address else ''}。")
+
+    def add_rollups(self, conn, mac_address, readings):
+        """
+        將 DataFrame 中的數據累加到彙總表（與觸發器相同的合併方式）。
+        """
+        for table, size in ROLLUP_TABLES.values():
+            bucket_ts = readings["ts"] - (readings["ts"] + TAIPEI_OFFSET) % size
+            for col in SENSOR_COLUMNS.values():
+                grouped = readings[col].groupby(bucket_ts.rename("bucket_ts")).agg(["sum", "min", "max", "count"]).reset_index()
+                grouped = grouped[grouped["count"] > 0]
+                if not len(grouped):
+                    continue
+                conn.execute(text(f"""
+                    INSERT INTO {table} (mac_address, metric, bucket_ts, sum, min, max, count)
+                    VALUES (:mac_address, :metric, :bucket_ts, :sum, :min, :max, :count)
+                    ON CONFLICT(mac_address, metric, bucket_ts) DO UPDATE SET
+                        sum = {table}.sum + excluded.sum, min = MIN({table}.min, excluded.min),
+                        max = MAX({table}.max, excluded.max), count = {table}.count + excluded.count
+                """), [{"mac_address": mac_address, "metric": col, "bucket_ts": int(r.bucket_ts), "sum": float(r.sum),
+                        "min": float(r.min), "max": float(r.max), "count": int(r.count)} for r in grouped.itertuples()])
+
+    def retention_cutoff(self, days):
+        """
+        保留 days 天時，早於此時間（台北時間當日零時）的數據可刪除；days 為 None 時回傳 0。
+        """
+        if not days:
+            return 0
+        cutoff = int(time.time()) - int(days * 86400)
+        return cutoff - (cutoff + TAIPEI_OFFSET) % 86400
+
+    def expire_raw_readings(self):
+        """
+        依 raw_retention_days 刪除過舊的原始數據（sensor_readings 中已鏡像的數據與整月的 Parquet 封存），
+        依 hourly_retention_days 刪除過舊的每小時彙總。長期趨勢由每日彙總保留，因此儲存空間有上限。
+        回傳刪除的原始數據筆數。
+        """
+        raw_cutoff = self.retention_cutoff(self.raw_retention_days)
+        hourly_cutoff = self.retention_cutoff(self.hourly_retention_days)
+        deleted = 0
+        with self.engine.begin() as conn:
+            if raw_cutoff:
+                macs = [r.mac_address for r in conn.execute(text(
+                    "SELECT DISTINCT mac_address FROM sensor_readings WHERE ts < :cutoff AND pending_mirror = 0"), {"cutoff": raw_cutoff})]
+                deleted = conn.execute(text("DELETE FROM sensor_readings WHERE ts < :cutoff AND pending_mirror = 0"),
+                                       {"cutoff": raw_cutoff}).rowcount
+                for mac_address in macs:
+                    self.shared.publish('readings', mac_address, conn)
+            if hourly_cutoff:
+                conn.execute(text(f"DELETE FROM {ROLLUP_TABLES['hour'][0]} WHERE bucket_ts < :cutoff"), {"cutoff": hourly_cutoff})
+        expired_files = self.archive.expire(raw_cutoff) if raw_cutoff and self.archive.enabled else 0
+        if deleted or expired_files or hourly_cutoff:
+            self.data_cache.invalidate()
+            logging.info(f"已依保留期限刪除 {deleted} 筆原始數據與 {expired_files} 個封存檔。")
+        return deleted
 # -----------------------------
 # Controller 層
 # -----------------------------
 class PlantController:
-    def __init__(self, app, model: PlantModel):
+    def __init__(self, app, model: PlantModel, long_poll_timeout=25, long_poll_max_timeout=60, server_timing=False):
         self.app = app
         self.model = model
         CORS(self.app)
-        # 新增：儲存 ESP 指令的暫存區
-        self.device_commands = {}
+        # 長輪詢：有新指令或重設時喚醒等待中的裝置請求
+        self.notifier = DeviceNotifier()
+        # 其他程序加入指令或設定重設時，喚醒本程序中等待的裝置
+        self.model.shared.subscribe('device', self.notifier.notify)
+        self.long_poll_timeout = long_poll_timeout
+        self.long_poll_max_timeout = long_poll_max_timeout
+        # server_timing=True 時在回應加上 Server-Timing 標頭（app、db、sheets、parse、json 各階段的毫秒數）
+        self.server_timing = server_timing
+        self.metrics = model.metrics
+        if self.metrics.enabled or server_timing:
+            self.app.before_request(self.start_request_timer)
+            self.app.after_request(self.finish_request_timer)
+        self.metrics.describe("http_request_duration_seconds", "histogram", "請求處理耗時（依路由）")
+        self.metrics.describe("http_requests_total", "counter", "請求次數（依路由與狀態碼）")
+        self.metrics.describe("json_serialize_duration_seconds", "histogram", "回應 JSON 序列化耗時")
+        self.metrics.gauge("long_poll_waiters", "等待指令中的長輪詢請求數",
+                           lambda: [({}, self.notifier.waiting_count())])
+        # 模板中以 {{ plant.photo_path | photo_variant('card') }} 取得縮圖網址
+        self.app.add_template_filter(self.photo_variant, 'photo_variant')
         self.register_routes()
 
+    def photo_variant(self, photo_path, variant):
+        if not photo_path or not photo_path.startswith(PHOTO_URL_PREFIX) or variant not in PHOTO_VARIANTS:
+            return photo_path
+        return f"{PHOTO_URL_PREFIX}{os.path.basename(photo_path).rsplit('.', 1)[0]}.{variant}.jpg"
+
+    def start_request_timer(self):
+        g.request_started = time.perf_counter()
+        g.server_timing = {}
+
+    def finish_request_timer(self, response):
+        elapsed = time.perf_counter() - g.request_started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        self.metrics.observe("http_request_duration_seconds", elapsed, method=request.method, route=route)
+        self.metrics.inc("http_requests_total", method=request.method, route=route, status=response.status_code)
+        if self.server_timing:
+            phases = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in g.server_timing.items()]
+            response.headers["Server-Timing"] = ", ".join([f"app;dur={elapsed * 1000:.1f}", *phases])
+        return response
+
+    def queue_commands(self, mac_address, commands):
+        queued = self.model.enqueue_commands(mac_address, commands)
+        self.notifier.notify(mac_address)
+        return queued
+
+    def parse_ingest_json(self, payload):
+        if isinstance(payload, list):
+            readings = payload
+        elif isinstance(payload, dict):
+            readings = payload.get("readings", [payload] if "mac_address" in payload else [])
+        else:
+            raise ValueError("JSON 格式錯誤")
+        if not isinstance(readings, list) or not all(isinstance(r, dict) for r in readings):
+            raise ValueError("readings 必須是物件陣列")
+        mac_address = payload.get("mac_address") if isinstance(payload, dict) else None
+        if mac_address:
+            readings = [{"mac_address": mac_address, **r} for r in readings]
+        return readings
+
+    def parse_ingest_csv(self, body):
+        columns = list(SENSOR_COLUMNS.values())
+        records = []
+        for line in body.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = [f.strip() for f in line.split(",")]
+            record = {"mac_address": fields[0]}
+            stamp = fields[1] if len(fields) > 1 else ""
+            if stamp.startswith("-"):
+                record["age"] = stamp[1:]
+            elif stamp:
+                record["ts"] = stamp
+            record.update(zip(columns, fields[2:]))
+            records.append(record)
+        return records
+
+    def command_response(self, commands):
+        """
+        指令回應格式：command 為第一個待執行指令（相容舊韌體），commands 為全部待執行指令。
+        """
+        if not commands:
+            return {"has_command": False}
+        return {
+            "has_command": True,
+            "command": {"case": commands[0]["case"], "value": commands[0]["value"]},
+            "commands": commands,
+            "last_seq": commands[-1]["seq"],
+        }
+
+    def export_chunks(self, plants, start_ts, end_ts, export_format):
+        """
+        逐批產生匯出內容（bytes），每批最多 EXPORT_CHUNK_ROWS 筆；時間為台北時間的 ISO 8601，缺值為空白/null。
+        """
+        headers = ["mac_address", *SHEET_HEADERS]
+        if export_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(headers)
+        for plant in plants:
+            for rows in self.model.iter_readings(plant.mac_address, start_ts, end_ts):
+                records = [[plant.mac_address, datetime.fromtimestamp(row[0], tz=TAIPEI_TZ).isoformat(),
+                            *[None if v is None or v != v else v for v in row[1:]]] for row in rows]
+                if export_format == "csv":
+                    writer.writerows(records)
+                    chunk = buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                else:
+                    chunk = "".join(json.dumps(dict(zip(headers, record)), ensure_ascii=False) + "\n" for record in records)
+                self.metrics.inc("export_rows_total", len(records), format=export_format)
+                yield chunk.encode("utf-8")
+                # gevent 伺服器上讓出執行權，大量匯出時其他請求（例如裝置長輪詢）不會被延遲
+                time.sleep(0)
+        if export_format == "csv" and buffer.tell():
+            yield buffer.getvalue().encode("utf-8")
+
+    def gzip_chunks(self, chunks):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
     def register_routes(self):
         # 網頁路由
         @self.app.route('/')
@@ -229,6 +2867,28 @@ class PlantController:
         def history():
             return render_template('history.html')
 
+        @self.app.route('/uploads/<filename>')
+        def uploaded_photo(filename):
+            """
+            照片以內容雜湊命名，內容永遠不變，可讓瀏覽器長期快取。
+            縮圖尚未產生（或未安裝 Pillow）時改送原圖，但不長期快取，之後可取得縮圖。
+            """
+            folder = self.model.upload_folder
+            parts = filename.split('.')
+            if len(parts) == 3 and parts[1] in PHOTO_VARIANTS and not os.path.exists(os.path.join(folder, filename)):
+                original = next((f"{parts[0]}.{ext}" for ext in PHOTO_EXTENSIONS
+                                 if os.path.exists(os.path.join(folder, f"{parts[0]}.{ext}"))), None)
+                if original is None:
+                    return jsonify({"error": "找不到照片"}), 404
+                response = send_from_directory(folder, original, max_age=0)
+                response.cache_control.no_cache = True
+                return response
+
+            response = send_from_directory(folder, filename, max_age=365 * 24 * 3600)
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            return response
+
         # API 路由
         @self.app.route('/api/plant/<int:plant_id>', methods=['GET'])
         def api_get_plant(plant_id):
@@ -281,6 +2941,8 @@ class PlantController:
                 self.model.update_plant(plant_id, name, file)
                 
                 return jsonify({"success": True, "message": "植物資料已成功更新！"})
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
             except Exception as e:
                 logging.error(f"更新植物錯誤: {e}")
                 return jsonify({"error": str(e)}), 500
@@ -293,16 +2955,126 @@ class PlantController:
             
             start_iso = request.args.get('start')
             end_iso = request.args.get('end')
+            # bucket 與 type 同時提供時，改為回傳伺服器端聚合後的序列
+            bucket = request.args.get('bucket')
+            metric = request.args.get('type') if bucket else None
             
             start_date = datetime.fromisoformat(start_iso.replace('Z', '+00:00')) if start_iso else None
             end_date = datetime.fromisoformat(end_iso.replace('Z', '+00:00')) if end_iso else None
             
-            logging.info(f"API 請求的 plant_id: {plant_id}, start_date: {start_date}, end_date: {end_date}")
+            logging.info(f"API 請求的 plant_id: {plant_id}, start_date: {start_date}, end_date: {end_date}, bucket: {bucket}")
             
-            data = self.model.get_plant_data(plant.sheet_id, plant.mac_address, start_date=start_date, end_date=end_date)
-            return jsonify({"data": data})
+            try:
+                data = self.model.get_plant_data(plant.sheet_id, plant.mac_address, start_date=start_date, end_date=end_date,
+                                                 bucket=bucket, metric=metric)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            with self.metrics.timer("json_serialize_duration_seconds", phase="json", route="/api/data"):
+                if bucket:
+                    return jsonify({"data": data, "bucket": bucket, "type": metric})
+                return jsonify({"data": data})
 
             
+        # 串流匯出歷史數據：?plant_id=1,2（可重複或以逗號分隔，未指定時為全部植物）&start=&end=
+        # &format=csv|ndjson&gzip=1；逐批讀取與輸出，記憶體用量與範圍大小無關
+        @self.app.route('/api/export', methods=['GET'])
+        def api_export():
+            export_format = request.args.get('format', 'csv')
+            if export_format not in ("csv", "ndjson"):
+                return jsonify({"error": "format 只支援 csv 或 ndjson"}), 400
+            try:
+                plant_ids = [int(value) for arg in request.args.getlist('plant_id') for value in arg.split(',') if value]
+                start_iso = request.args.get('start')
+                end_iso = request.args.get('end')
+                # 與 /api/data 相同：未指定時區的時間視為 UTC
+                start_ts = math.ceil(pd.to_datetime(start_iso, utc=True).timestamp()) if start_iso else 0
+                end_ts = math.floor(pd.to_datetime(end_iso, utc=True).timestamp()) if end_iso else int(time.time())
+            except ValueError:
+                return jsonify({"error": "plant_id、start 或 end 參數錯誤"}), 400
+
+            if plant_ids:
+                plants = [self.model.get_plant_by_id(plant_id) for plant_id in plant_ids]
+                if None in plants:
+                    return jsonify({"error": "找不到植物"}), 404
+            else:
+                plants = sorted(self.model.registry.all(), key=lambda plant: plant.id)
+
+            chunks = self.export_chunks(plants, start_ts, end_ts, export_format)
+            filename = f"plant-data.{export_format}"
+            mimetype = "text/csv" if export_format == "csv" else "application/x-ndjson"
+            if request.args.get('gzip') in ("1", "true"):
+                chunks = self.gzip_chunks(chunks)
+                filename += ".gz"
+                mimetype = "application/gzip"
+            response = Response(stream_with_context(chunks), mimetype=mimetype)
+            response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+            return response
+
+        @self.app.route('/api/latest', methods=['GET'])
+        def api_latest_all():
+            """
+            一次回傳所有植物的最新數據，供首頁使用。
+            """
+            data = []
+            for plant in self.model.get_all_plants():
+                data.append({
+                    "plant_id": plant["id"],
+                    "mac_address": plant["mac_address"],
+                    "reading": self.model.get_latest_reading(plant["mac_address"]),
+                })
+            return jsonify({"data": data})
+
+        @self.app.route('/api/overview', methods=['GET'])
+        def api_overview():
+            """
+            首頁一次取得所有植物與最新數據，不論植物數量都只需要一個請求。
+            """
+            return jsonify({"data": self.model.get_overview()})
+
+        @self.app.route('/api/latest/<int:plant_id>', methods=['GET'])
+        def api_latest(plant_id):
+            plant = self.model.get_plant_by_id(plant_id)
+            if not plant:
+                return jsonify({"error": "找不到植物"}), 404
+            return jsonify({"data": self.model.fetch_latest_reading({"sheet_id": plant.sheet_id, "mac_address": plant.mac_address})})
+
+        # 最近數據的滾動統計（平均、最小、最大、每小時斜率）與自動澆水規則
+        @self.app.route('/api/stats/<int:plant_id>', methods=['GET'])
+        def api_stats(plant_id):
+            plant = self.model.get_plant_by_id(plant_id)
+            if not plant:
+                return jsonify({"error": "找不到此植物"}), 404
+            return jsonify({"data": self.model.get_rolling_stats(plant.mac_address),
+                            "rule": self.model.water_rules.get(plant.mac_address)})
+
+        @self.app.route('/api/jobs/<int:job_id>', methods=['GET'])
+        def api_job_status(job_id):
+            job = self.model.jobs.get(job_id)
+            if not job:
+                return jsonify({"error": "找不到此工作"}), 404
+            return jsonify(job)
+
+        @self.app.route('/api/cache_stats', methods=['GET'])
+        def cache_stats():
+            return jsonify(self.model.cache_stats())
+
+        # 存活檢查：不依賴資料庫與 Google，程序能處理請求即回應 200
+        @self.app.route('/healthz', methods=['GET'])
+        def healthz():
+            return jsonify({"status": "ok"})
+
+        # 就緒檢查：資料庫可用即回應 200；Google Sheets 的狀態只供參考，無法連線時裝置 API 照常服務
+        @self.app.route('/readyz', methods=['GET'])
+        def readyz():
+            ready, checks = self.model.check_ready()
+            return jsonify({"status": "ready" if ready else "unavailable", "checks": checks}), 200 if ready else 503
+
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics():
+            if not self.metrics.enabled:
+                return jsonify({"error": "效能指標未啟用"}), 404
+            return Response(self.metrics.render(), mimetype='text/plain; version=0.0.4')
+
         @self.app.route('/api/remote_reset', methods=['POST'])
         def api_remote_reset():
             try:
@@ -312,13 +3084,10 @@ class PlantController:
                     return jsonify({"error": "MAC 地址不能為空"}), 400
 
                 # 在資料庫中設定 reset_flag
-                with self.model.engine.connect() as conn:
-                    result = conn.execute(text("UPDATE plants SET reset_flag = 1 WHERE mac_address = :mac_address"), {"mac_address": mac_address})
-                    conn.commit()
-                
-                if result.rowcount == 0:
+                if not self.model.set_reset_flag(mac_address, 1):
                     return jsonify({"error": "找不到此 MAC 位址的裝置"}), 404
 
+                self.notifier.notify(mac_address)
                 return jsonify({"success": True, "message": f"已設定遠端重設指令給 {mac_address}"})
             except Exception as e:
                 return jsonify({"error": str(e)}), 500
@@ -335,28 +3104,64 @@ class PlantController:
                 if not mac_address:
                     return jsonify({"error": "MAC 地址不能為空"}), 400
                 if self.model.get_plant_by_mac(mac_address):
+                    # 先前建立工作表的背景工作已放棄時重新送出，讓裝置重新配對即可修復
+                    job_id = self.model.resubmit_create_worksheet(mac_address, only_failed=True)
+                    if job_id is not None:
+                        return jsonify({"success": True, "message": "裝置已配對，重新建立工作表。", "job_id": job_id})
                     return jsonify({"success": True, "message": "裝置已配對。"})
-                if not self.model.create_worksheet(mac_address):
-                    return jsonify({"error": "無法建立 Google Sheets 工作表"}), 500
                 photo_path = 'https://via.placeholder.com/150'
                 self.model.add_plant(plant_name, photo_path, mac_address)
-                return jsonify({"success": True, "message": "裝置配對成功！"})
+                # 工作表由背景工作建立，不阻塞配對請求
+                job_id = self.model.jobs.submit('create_worksheet', {"mac_address": mac_address}, key=mac_address)
+                return jsonify({"success": True, "message": "裝置配對成功！", "job_id": job_id})
             except Exception as e:
                 logging.error(f"裝置配對錯誤: {e}")
                 return jsonify({"error": str(e)}), 500
 
+        @self.app.route('/api/ingest', methods=['POST'])
+        def api_ingest():
+            """
+            批次寫入感測數據，一次可包含一台或多台裝置。支援兩種格式：
+            - JSON：{"mac_address": ..., "readings": [...]}、{"readings": [{"mac_address": ..., ...}]} 或陣列
+            - CSV（text/csv 或 text/plain）：每行「mac,ts,溫度,濕度,土壤濕度,光照度」，
+              ts 留空表示現在，-N 表示 N 秒前
+            """
+            try:
+                if request.is_json:
+                    payload = request.get_json(silent=True)
+                    if payload is None:
+                        return jsonify({"error": "JSON 格式錯誤"}), 400
+                    records = self.parse_ingest_json(payload)
+                else:
+                    records = self.parse_ingest_csv(request.get_data(as_text=True))
+                if not records:
+                    return jsonify({"error": "沒有數據"}), 400
+
+                readings, invalid = self.model.build_ingest_frame(records)
+                macs = readings["mac_address"].unique().tolist()
+                known = [mac for mac in macs if self.model.get_plant_by_mac(mac)]
+                rejected = sorted(set(macs) - set(known))
+                inserted = self.model.ingest_readings(readings[readings["mac_address"].isin(known)])
+                return jsonify({
+                    "success": True,
+                    "received": len(records),
+                    "inserted": inserted,
+                    "rejected": rejected,
+                    "invalid": invalid,
+                })
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            except Exception as e:
+                logging.error(f"寫入感測數據錯誤: {e}")
+                return jsonify({"error": str(e)}), 500
+
         @self.app.route('/api/check_reset/<mac_address>', methods=['GET'])
         @self.app.route('/api/check_reset/<mac_address>/', methods=['GET'])
         def check_reset(mac_address):
             try:
-                plant = self.model.get_plant_by_mac(mac_address)
-                if not plant:
+                reset_pending = self.model.pop_reset_flag(mac_address)
+                if reset_pending is None:
                     return jsonify({"error": "找不到此 MAC 位址的裝置"}), 404
-                reset_pending = plant.reset_flag == 1
-                if reset_pending:
-                    with self.model.engine.connect() as conn:
-                        conn.execute(text("UPDATE plants SET reset_flag = 0 WHERE mac_address = :mac_address"), {"mac_address": mac_address})
-                        conn.commit()
                 return jsonify({"reset_pending": reset_pending})
             except Exception as e:
                 logging.error(f"檢查遠端重設錯誤: {e}")
@@ -371,30 +3176,64 @@ class PlantController:
                 value = data.get("value")
                 if not mac_address or caseswitch is None or value is None:
                     return jsonify({"error": "缺少參數"}), 400
-                self.device_commands[mac_address] = {
+                queued = self.queue_commands(mac_address, [{
                     "case": int(caseswitch),
                     "value": int(value)
-                }
+                }])
                 return jsonify({
                     "message": f"已設定指令給 {mac_address}",
-                    "command": self.device_commands[mac_address]
+                    "command": queued[0]
                 }), 200
             except Exception as e:
                 return jsonify({"error": str(e)}), 500
 
         @self.app.route('/api/get_command/<mac_address>', methods=['GET'])
         def get_command(mac_address):
-            command = self.device_commands.get(mac_address)
-            if command:
-                return jsonify({"has_command": True, "command": command})
-            else:
-                return jsonify({"has_command": False})
+            return jsonify(self.command_response(self.model.get_pending_commands(mac_address)))
+
+        @self.app.route('/api/wait_command/<mac_address>', methods=['GET'])
+        def wait_command(mac_address):
+            """
+            長輪詢：保留請求直到有指令或遠端重設，或等待逾時（timeout 秒）。
+            同時取代 /api/get_command 與 /api/check_reset 的定期輪詢。
+            """
+            try:
+                timeout = min(float(request.args.get('timeout', self.long_poll_timeout)), self.long_poll_max_timeout)
+            except ValueError:
+                return jsonify({"error": "timeout 參數錯誤"}), 400
+
+            event = self.notifier.subscribe(mac_address)
+            try:
+                deadline = time.monotonic() + timeout
+                while True:
+                    reset_pending = self.model.pop_reset_flag(mac_address)
+                    if reset_pending is None:
+                        return jsonify({"error": "找不到此 MAC 位址的裝置"}), 404
+                    commands = self.model.get_pending_commands(mac_address)
+                    if commands or reset_pending:
+                        return jsonify({**self.command_response(commands), "reset_pending": reset_pending})
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not event.wait(remaining):
+                        return jsonify({"has_command": False, "reset_pending": False})
+                    event.clear()
+            finally:
+                self.notifier.unsubscribe(mac_address, event)
 
         # 新增一個 API，讓裝置在執行指令後可以回報
+        # body 的 seq 表示已執行到哪個指令；未提供時（舊韌體）只移除第一個待執行指令
         @self.app.route('/api/command_executed/<mac_address>', methods=['POST'])
         def command_executed(mac_address):
-            if mac_address in self.device_commands:
-                del self.device_commands[mac_address]
+            data = request.get_json(silent=True) or {}
+            seq = data.get("seq") if isinstance(data, dict) else None
+            if seq is None:
+                pending = self.model.get_pending_commands(mac_address)
+                seq = pending[0]["seq"] if pending else None
+            else:
+                try:
+                    seq = int(seq)
+                except (TypeError, ValueError):
+                    return jsonify({"error": "seq 參數錯誤"}), 400
+            if seq is not None and self.model.ack_commands(mac_address, seq):
                 return jsonify({"success": True, "message": "指令已從佇列移除"})
             return jsonify({"success": False, "message": "指令不存在"})
 
@@ -405,7 +3244,6 @@ class PlantController:
                 plant_id = data.get("plant_id")
                 enabled = data.get("enabled")
                 threshold = data.get("threshold")
-                print(threshold)
                 if not plant_id or enabled is None or threshold is None:
                     return jsonify({"error": "缺少參數"}), 400
 
@@ -416,18 +3254,20 @@ class PlantController:
                 
                 mac_address = plant.mac_address
 
-                self.device_commands[mac_address] = {
-                    "case": 1, 
-                    "value": int(threshold)
-                }
-
-                self.device_commands[mac_address] = {
-                    "case": 4, 
-                    "value": 1 if enabled else 0
-                }
+                try:
+                    commands = [
+                        {"case": 1, "value": int(threshold)},
+                        {"case": 4, "value": 1 if enabled else 0},
+                    ]
+                    # 伺服器端也依滾動統計評估同一條規則；UNO 重新開機遺失設定時仍會收到澆水指令
+                    rule, _ = self.model.set_water_rule(mac_address, enabled, threshold, data.get("cooldown"), commands)
+                except (TypeError, ValueError):
+                    return jsonify({"error": "threshold 與 cooldown 必須是數字"}), 400
+                self.notifier.notify(mac_address)
                 return jsonify({
                     "message": "已設定澆水指令",
-                    "mac_address": mac_address
+                    "mac_address": mac_address,
+                    "rule": rule
                 }), 200
 
             except Exception as e:
@@ -455,8 +3295,8 @@ class PlantController:
                     "value": 1
                 }
                 
-                # 將指令儲存到暫存區
-                self.device_commands[mac_address] = command
+                # 將指令加入裝置的佇列
+                self.queue_commands(mac_address, [command])
                 
                 logging.info(f"已設定立即澆水指令給 {mac_address} (植物 ID: {plant_id})")
                 return jsonify({
@@ -473,8 +3313,20 @@ class PlantController:
 # -----------------------------
 # 啟動應用程式
 # -----------------------------
-if __name__ == '__main__':
+def create_app(start_background=True, controller_options=None, **model_options):
+    """
+    建立 Flask 應用程式；model_options 傳給 PlantModel，controller_options 傳給 PlantController。
+    多個 worker 程序（例如 gunicorn -w N）各自呼叫一次，彼此經由資料庫共享指令佇列、背景工作與快取失效事件。
+    """
     app = Flask(__name__)
-    model = PlantModel(app)
-    controller = PlantController(app, model)
-    controller.app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    model = PlantModel(app, **model_options)
+    PlantController(app, model, **(controller_options or {}))
+    if start_background:
+        model.start_background()
+    return app
+
+
+if __name__ == '__main__':
+    # debug 模式的 reloader 會啟動兩個程序，只在實際服務請求的子程序中啟動背景工作
+    app = create_app(start_background=os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
+    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
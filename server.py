@@ -0,0 +1,16 @@
+# 必須在匯入 Flask 與其他模組之前完成 monkey patch，
+# 讓長輪詢的等待改為協程，不必為每台等待中的裝置保留一個執行緒
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+
+from gevent.pywsgi import WSGIServer
+
+from flask_app import create_app
+
+
+if __name__ == '__main__':
+    app = create_app()
+    logging.info("以 gevent WSGIServer 啟動於 0.0.0.0:5000")
+    WSGIServer(('0.0.0.0', 5000), app).serve_forever()
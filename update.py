@@ -1,69 +1,69 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import pandas as pd
-from sqlalchemy import create_engine, text
-from flask_app import get_plant_data
+import time
+import logging
+import argparse
 
-engine = create_engine('sqlite:///plant_data.db')
-# 你的 Google Sheets API 憑證設定
-# 請將你的 JSON 憑證檔案路徑替換成實際路徑
-scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-creds = ServiceAccountCredentials.from_json_keyfile_name('smart-planting-468806-f5b899621000.json', scope)
-client = gspread.authorize(creds)
-spreadsheet = client.open('smart')
-worksheet = spreadsheet.get_worksheet(0)
+from flask import Flask
 
-# 我們把數據清洗的邏輯包裝在一個函式裡
-def get_and_clean_data_without_headers():
+from flask_app import PlantModel
+
+
+def write_to_database(model):
     """
-    從 Google Sheets 讀取數據並進行清洗。
+    將 plants 資料表中所有植物的工作表增量同步到本地 sensor_readings。
+    每個工作表只讀取同步水位之後的新列，並以 (mac_address, ts) 去除重複。
     """
     try:
-        data = worksheet.get_all_values()
-        if not data:
-            return None
-        column_names = ['時間', '環境溫度', '環境濕度', '土壤濕度', '光照度']
-        df = pd.DataFrame(data, columns=column_names)
-        
-        numeric_cols = ['環境溫度', '環境濕度', '土壤濕度', '光照度']
-        for col in numeric_cols:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        df['時間'] = pd.to_datetime(df['時間'], errors='coerce', format='%Y-%m-%d %H:%M')
-        df.ffill(inplace=True)
-        # 新增 id 欄位，這將作為每一筆數據的唯一識別碼
-        # 我們可以使用 DataFrame 的索引作為 id
-        df.reset_index(inplace=True)
-        df.rename(columns={'index': 'id'}, inplace=True)        
-        return df
-
-    except gspread.exceptions.APIError as e:
-        print(f"連線 Google Sheets 時發生錯誤: {e}")
-        return None
+        results = model.sync_worksheets()
     except Exception as e:
-        print(f"處理數據時發生錯誤: {e}")
-        return None
+        print(f"同步資料時發生錯誤: {e}")
+        return
 
-def write_to_database():
+    total = sum(results.values())
+    print(f"同步完成：{len(results)} 個工作表，新增 {total} 筆數據。")
+    print(f"資料庫檔案路徑: {model.engine.url.database}")
+
+
+def compact_archive(model):
     """
-    將清洗後的數據寫入 SQLite 資料庫。
+    將已結束月份的數據封存到 Parquet（需安裝 pyarrow），並從 sensor_readings 移除。
     """
-    cleaned_df = get_and_clean_data_without_headers()
-    
-    if cleaned_df is None:
-        print("無法取得數據，跳過寫入資料庫。")
+    if not model.archive.enabled:
+        return
+    for plant in model.get_all_plants():
+        try:
+            model.compact_closed_months(plant["mac_address"])
+        except Exception as e:
+            print(f"封存 {plant['mac_address']} 時發生錯誤: {e}")
+
+
+def expire_old_readings(model):
+    """
+    依保留期限刪除過舊的原始數據與每小時彙總；長期數據仍保留在每日彙總中。
+    """
+    if not model.raw_retention_days:
         return
-    
-    # 將 Pandas DataFrame 寫入資料庫中的 'plant_data' 資料表
-    # if_exists='replace' 會在每次執行時刪除舊資料表並創建新的
-    # 更好的方式是使用 'append' 來新增資料，但需要處理重複數據
     try:
-        cleaned_df.to_sql('plant_data', engine, if_exists='replace', index=False)
-        print("數據已成功寫入資料庫！")
-        print(f"資料庫檔案路徑: {engine.url.database}")
-        
+        deleted = model.expire_raw_readings()
+        print(f"已刪除 {deleted} 筆超過 {model.raw_retention_days} 天的原始數據。")
     except Exception as e:
-        print(f"寫入資料庫時發生錯誤: {e}")
+        print(f"刪除過舊數據時發生錯誤: {e}")
+
 
 if __name__ == '__main__':
-    write_to_database()
+    parser = argparse.ArgumentParser(description="將 Google Sheets 的感測數據增量同步到本地資料庫")
+    parser.add_argument('--interval', type=int, default=0, help="每隔幾秒同步一次；0 表示只同步一次")
+    parser.add_argument('--retention-days', type=float, default=None, help="原始數據保留天數；未指定時永久保留")
+    parser.add_argument('--hourly-retention-days', type=float, default=None, help="每小時彙總保留天數（不少於原始數據）")
+    args = parser.parse_args()
+
+    model = PlantModel(Flask(__name__), raw_retention_days=args.retention_days, hourly_retention_days=args.hourly_retention_days)
+    logging.getLogger().setLevel(logging.INFO)
+    while True:
+        # 伺服器在本程序啟動後新增或刪除的植物，由每次重新載入取得
+        model.reload_registry()
+        write_to_database(model)
+        compact_archive(model)
+        expire_old_readings(model)
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval)
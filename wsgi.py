@@ -0,0 +1,11 @@
+"""
+正式環境的進入點。每個 worker 程序各自建立應用程式，彼此經由 plant_data.db 共享指令佇列、
+背景工作與快取失效事件，因此可以用多個程序使用所有 CPU 核心：
+
+    gunicorn -k gevent -w 4 -b 0.0.0.0:5000 wsgi:app
+
+不要加上 --preload：背景執行緒與資料庫連線必須在每個 worker 啟動之後才建立。
+"""
+from flask_app import create_app
+
+app = create_app()